@@ -0,0 +1,168 @@
+import cv2
+import numpy as np
+
+# Number of known pixels kept around each padded band, so that the fill sees
+# the same neighbourhood as when inpainting the whole canvas
+DEFAULT_CONTEXT_MARGIN = 32
+
+INPAINT_METHODS = {
+    "telea": cv2.INPAINT_TELEA,
+    "ns": cv2.INPAINT_NS,
+}
+
+BORDER_TYPES = {
+    "replicate": cv2.BORDER_REPLICATE,
+    "reflect": cv2.BORDER_REFLECT,
+}
+
+BLEED_FILL_STRATEGIES = [*INPAINT_METHODS, *BORDER_TYPES, "blur-replicate"]
+
+
+def inpaint_full(img, padding_lrtb, radius: int, method: int):
+    l, r, t, b = (max(0, p) for p in padding_lrtb)
+    h, w = img.shape[:2]
+
+    mask = np.full((h, w), 255, dtype=np.uint8)
+    mask[t : h - b, l : w - r] = 0
+    return cv2.inpaint(img, mask, radius, method)
+
+
+def _tiles(start: int, stop: int, tile_size: int | None):
+    if tile_size is None:
+        yield start, stop
+        return
+    for tile_start in range(start, stop, tile_size):
+        yield tile_start, min(stop, tile_start + tile_size)
+
+
+def inpaint_bands(
+    img,
+    padding_lrtb,
+    radius: int,
+    method: int,
+    margin=DEFAULT_CONTEXT_MARGIN,
+    max_window_pixels: int | None = None,
+    in_place=False,
+):
+    # Only the padded bands along the edges are unknown, so inpaint a window
+    # around each band (plus some known context) instead of the whole canvas.
+    # Each window sees the same mask as the full canvas would, including the
+    # corners, but only its own band is written back. The top and bottom bands
+    # include the corners.
+    #
+    # If `max_window_pixels` is given, the bands are additionally split along
+    # their length into tiles, so that no window is larger than that. Writing
+    # in place is safe since the values of masked pixels are never read.
+    l, r, t, b = (max(0, p) for p in padding_lrtb)
+    h, w = img.shape[:2]
+    out = img if in_place else np.array(img, copy=True)
+
+    def fill(rows: slice, cols: slice, write_rows: slice, write_cols: slice):
+        if write_rows.start >= write_rows.stop or write_cols.start >= write_cols.stop:
+            return
+        window = np.array(img[rows, cols], order="C")
+        row_offset, col_offset = rows.start, cols.start
+
+        mask = np.full(window.shape[:2], 255, dtype=np.uint8)
+        known_rows = slice(max(0, t - row_offset), max(0, h - b - row_offset))
+        known_cols = slice(max(0, l - col_offset), max(0, w - r - col_offset))
+        mask[known_rows, known_cols] = 0
+
+        filled = cv2.inpaint(window, mask, radius, method)
+        out[write_rows, write_cols] = filled[
+            write_rows.start - row_offset : write_rows.stop - row_offset,
+            write_cols.start - col_offset : write_cols.stop - col_offset,
+        ]
+
+    def tile_size(depth: int) -> int | None:
+        if max_window_pixels is None:
+            return None
+        return max(1, max_window_pixels // depth - 2 * margin)
+
+    def fill_rows(rows: slice, write_rows: slice):
+        for start, stop in _tiles(0, w, tile_size(rows.stop - rows.start)):
+            cols = slice(max(0, start - margin), min(w, stop + margin))
+            fill(rows, cols, write_rows, slice(start, stop))
+
+    def fill_cols(cols: slice, write_cols: slice):
+        for start, stop in _tiles(0, h, tile_size(cols.stop - cols.start)):
+            rows = slice(max(0, start - margin), min(h, stop + margin))
+            write_rows = slice(max(t, start), min(h - b, stop))
+            fill(rows, cols, write_rows, write_cols)
+
+    if t > 0:
+        fill_rows(slice(0, min(h, t + margin)), slice(0, t))
+    if b > 0:
+        fill_rows(slice(max(0, h - b - margin), h), slice(h - b, h))
+    if l > 0:
+        fill_cols(slice(0, min(w, l + margin)), slice(0, l))
+    if r > 0:
+        fill_cols(slice(max(0, w - r - margin), w), slice(w - r, w))
+
+    return out
+
+
+def _inner_region(img, padding_lrtb):
+    l, r, t, b = (max(0, p) for p in padding_lrtb)
+    h, w = img.shape[:2]
+    return img[t : h - b, l : w - r], (l, r, t, b)
+
+
+def pad_border(img, padding_lrtb, border_type: int):
+    inner, (l, r, t, b) = _inner_region(img, padding_lrtb)
+    return cv2.copyMakeBorder(inner, t, b, l, r, border_type)
+
+
+def pad_blurred_border(img, padding_lrtb):
+    # Replicate the edge pixels, then blur only the padded area, so that the
+    # streaks produced by replication turn into a soft continuation of the edge
+    padded = pad_border(img, padding_lrtb, cv2.BORDER_REPLICATE)
+    l, r, t, b = (max(0, p) for p in padding_lrtb)
+    h, w = padded.shape[:2]
+    sigma = max(1.0, max(l, r, t, b) / 4)
+    margin = int(3 * sigma) + 1
+
+    out = padded.copy()
+    for rows, cols, write_rows, write_cols in [
+        (slice(0, t + margin), slice(0, w), slice(0, t), slice(0, w)),
+        (slice(h - b - margin, h), slice(0, w), slice(h - b, h), slice(0, w)),
+        (slice(0, h), slice(0, l + margin), slice(0, h), slice(0, l)),
+        (slice(0, h), slice(w - r - margin, w), slice(0, h), slice(w - r, w)),
+    ]:
+        rows = slice(max(0, rows.start), min(h, rows.stop))
+        cols = slice(max(0, cols.start), min(w, cols.stop))
+        if write_rows.start >= write_rows.stop or write_cols.start >= write_cols.stop:
+            continue
+        blurred = cv2.GaussianBlur(
+            padded[rows, cols], (0, 0), sigma, borderType=cv2.BORDER_REPLICATE
+        )
+        out[write_rows, write_cols] = blurred[
+            write_rows.start - rows.start : write_rows.stop - rows.start,
+            write_cols.start - cols.start : write_cols.stop - cols.start,
+        ]
+    return out
+
+
+def fill_bleed(
+    img,
+    padding_lrtb,
+    strategy: str,
+    radius: int,
+    inpaint_mode="band",
+):
+    # `img` is the padded canvas; only the pixels of the positive padding are
+    # replaced
+    if strategy in INPAINT_METHODS:
+        method = INPAINT_METHODS[strategy]
+        if inpaint_mode == "band":
+            return inpaint_bands(img, padding_lrtb, radius, method)
+        elif inpaint_mode == "full":
+            return inpaint_full(img, padding_lrtb, radius, method)
+        else:
+            raise ValueError(inpaint_mode)
+    elif strategy in BORDER_TYPES:
+        return pad_border(img, padding_lrtb, BORDER_TYPES[strategy])
+    elif strategy == "blur-replicate":
+        return pad_blurred_border(img, padding_lrtb)
+    else:
+        raise ValueError(strategy)
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Iterable
+
+JOURNAL_VERSION = 1
+
+
+def data_key(data: Any) -> str:
+    data_json = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(data_json.encode("utf-8")).hexdigest()
+
+
+def file_fingerprints(paths: Iterable[Path]) -> dict[str, list[int] | None]:
+    # Like the image index, a file counts as unchanged as long as its size and
+    # modification time are, so checking a stage only costs a `stat` per file
+    fingerprints = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            fingerprints[str(path)] = [stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            fingerprints[str(path)] = None
+    return fingerprints
+
+
+class BuildJournal:
+    # Records each completed stage of a build with a key of its inputs and the
+    # fingerprints of its outputs. A stage whose inputs and outputs are both
+    # unchanged is skipped, so a build that failed late resumes from the stage
+    # that failed
+    path: Path
+    stages: dict[str, dict]
+
+    def __init__(self, path: Path, fresh=False):
+        self.path = Path(path)
+        self.stages = {}
+
+        if fresh:
+            self.path.unlink(missing_ok=True)
+            return
+        try:
+            data = json.loads(self.path.read_text())
+            if data.get("version") == JOURNAL_VERSION:
+                self.stages = data["stages"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def is_done(self, stage: str, inputs: Any) -> bool:
+        entry = self.stages.get(stage)
+        if entry is None or entry["inputs"] != data_key(inputs):
+            return False
+        outputs = entry["outputs"]
+        return None not in outputs.values() and outputs == file_fingerprints(
+            Path(p) for p in outputs
+        )
+
+    def result(self, stage: str) -> Any:
+        return self.stages[stage].get("result")
+
+    def start(self, stage: str):
+        # A stage that is interrupted must not look completed to the next build
+        if self.stages.pop(stage, None) is not None:
+            self.save()
+
+    def record(
+        self, stage: str, inputs: Any, outputs: Iterable[Path], result: Any = None
+    ):
+        self.stages[stage] = {
+            "inputs": data_key(inputs),
+            "outputs": file_fingerprints(outputs),
+            "result": result,
+        }
+        self.save()
+
+    def save(self):
+        data = {"version": JOURNAL_VERSION, "stages": self.stages}
+        temp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        temp_path.write_text(json.dumps(data, indent=2, sort_keys=True))
+        os.replace(temp_path, self.path)
@@ -16,9 +16,9 @@ except ImportError:
 
 import numpy as np
 import oyaml as yaml
-from PIL import Image
 
 from .debug_printable import DebugPrintable
+from .image_index import ImageIndex
 
 
 class Book(DebugPrintable):
@@ -123,9 +123,11 @@ def parse_book_config(directory: str):
 
 class BaseImagesConfig(DebugPrintable):
     directory: Path
+    index: ImageIndex
 
     def __init__(self):
         self.directory = None
+        self.index = None
 
     @classmethod
     def from_file(cls, config_file):
@@ -137,6 +139,7 @@ class BaseImagesConfig(DebugPrintable):
         data = yaml.safe_load(config_file.read_text())
         config = cls()
         config.directory = config_file.parent.resolve()
+        config.index = ImageIndex(config.directory)
         config.parse_yaml(data)
         return config
 
@@ -239,6 +242,7 @@ PAPER_H_IN = 8.25
 class ImageInfo(ABC, DebugPrintable):
     parent: BaseImagesConfig
     is_filler: bool
+    bleed_fill: str | None
     _filepath: str
     _height_inches: float
     _offset_px: tuple[int, int]
@@ -246,6 +250,7 @@ class ImageInfo(ABC, DebugPrintable):
     def __init__(self, parent_config: BaseImagesConfig, yaml_node: dict):
         self.parent = parent_config
         self.is_filler = yaml_node.get("filler", False)
+        self.bleed_fill = yaml_node.get("bleed_fill")
         self._filepath = yaml_node["filepath"]
 
         self._height_inches = PAPER_H_IN
@@ -306,13 +311,54 @@ class ImageInfo(ABC, DebugPrintable):
 
         return left, right, top, bottom
 
+    def validate(self, bleed_size: float) -> "list[str]":
+        # Checks everything `padding_lrtb` relies on, without decoding the
+        # image, and returns a description of each problem found
+        path = self.absolute_image_path()
+        if not path.exists():
+            return [f"{path}: File does not exist"]
+        try:
+            img_w, img_h = self.size_px
+        except Exception as e:
+            return [f"{path}: Could not read image header: {e}"]
+        if img_w <= 0 or img_h <= 0:
+            return [f"{path}: Invalid size {(img_w, img_h)}"]
+
+        try:
+            canvas_w, canvas_h = self.canvas_size_px(bleed_size)
+        except AssertionError as e:
+            return [f"{path}: Image cannot cover the page (canvas size {e})"]
+
+        errors = []
+        overlap_px = getattr(self, "_overlap_px", 0)
+        if overlap_px < 0 or canvas_w <= 0 or canvas_h <= 0:
+            errors.append(
+                f"{path}: Invalid canvas size {(canvas_w, canvas_h)} (overlap {overlap_px}px)"
+            )
+        if (canvas_w - img_w) % 2 != 0 or (canvas_h - img_h) % 2 != 0:
+            errors.append(
+                f"{path}: Image size {(img_w, img_h)} cannot be centered on canvas {(canvas_w, canvas_h)}"
+            )
+        if errors:
+            return errors
+
+        l, r, t, b = self.padding_lrtb(bleed_size)
+        if img_w - max(0, -l) - max(0, -r) <= 0 or img_h - max(0, -t) - max(0, -b) <= 0:
+            errors.append(
+                f"{path}: Offset {self._offset_px} moves the image off the canvas"
+            )
+        return errors
+
     @property
     def size_px(self):
         if not hasattr(self, "_size_px") or self._size_px is None:
-            im = Image.open(self.absolute_image_path())
-            self._size_px = im.size
+            self._size_px = self.parent.index.size(self.relative_image_path())
         return self._size_px
 
+    @property
+    def sha256(self) -> str:
+        return self.parent.index.sha256(self.relative_image_path())
+
     @property
     def width_px(self) -> int:
         return self.size_px[0]
@@ -37,6 +37,9 @@ class EPUBGenerator:
     text_directory: Path
     chapters: "list[Chapter]"
     images_config: ImagesConfig
+    # Maps image file names to the file actually stored in the package, for
+    # images that are identical to an earlier one
+    image_files: dict[str, str]
 
     @classmethod
     def from_book_config(cls, book_config: Book, images_config: ImagesConfig):
@@ -46,8 +49,15 @@ class EPUBGenerator:
         book.text_directory = book_config.text_directory()
         book.chapters = book_config.chapters
         book.images_config = images_config
+        book.image_files = {}
         return book
 
+    def image_href(self, name: str) -> str:
+        return f"images/{self.image_files.get(name, name)}"
+
+    def is_stored_image(self, name: str) -> bool:
+        return self.image_files.get(name, name) == name
+
     def process_line(self, line: str, state: EPUBState) -> str:
         span = regex.match(r'^<span class="v-centered-page">(.+?)</span>$', line)
 
@@ -177,11 +187,16 @@ class EPUBGenerator:
             "<body>\n"
             '<div class="galley-rw">\n'
             '<section id="chapter{CHAPTER_NUMBER:03}" class="body-rw Chapter-rw" epub:type="bodymatter chapter">\n'
-            '<div class="image_full"><img alt="Book Title Page" src="images/Art_chapter{CHAPTER_NUMBER:03}.jpg"/></div>\n'
+            '<div class="image_full"><img alt="Book Title Page" src="{CHAPTER_IMAGE}"/></div>\n'
             "</section>\n"
             "</div>\n"
             "</body>\n"
             "</html>",
+            extra_replacements={
+                "CHAPTER_IMAGE": self.image_href(
+                    f"Art_chapter{self.chapters[chapter_number - 1].number:03}.jpg"
+                )
+            },
             start=chapter_number,
         )
 
@@ -236,12 +251,13 @@ class EPUBGenerator:
             '<section class="frontmatter-rw TitlePage-rw exclude-print-rw" id="BookTitlePage1" epub:type="frontmatter titlepage">\n'
             '<div class="width-90">\n'
             '<div class="pc">\n'
-            '<img alt="Book Title Page" src="images/Art_tit.jpg"/>\n'
+            '<img alt="Book Title Page" src="{TITLE_IMAGE}"/>\n'
             "</div>\n"
             "</div>\n"
             "</section>\n"
             "</body>\n"
             "</html>",
+            extra_replacements={"TITLE_IMAGE": self.image_href("Art_tit.jpg")},
         )
 
     def generate_insert_pages(self, insert_number: int) -> str:
@@ -255,12 +271,15 @@ class EPUBGenerator:
             "<body>\n"
             '<section id="insert{INSERT_NUMBER:03}" epub:type="frontmatter titlepage">\n'
             '<div class="image_full">\n'
-            '<img src="images/Art_insert{INSERT_NUMBER:03}.jpg" alt="Book Title Page"/>\n'
+            '<img src="{INSERT_IMAGE}" alt="Book Title Page"/>\n'
             "</div>\n"
             "</section>\n"
             "</body>\n"
             "</html>",
-            extra_replacements={"INSERT_NUMBER": insert_number},
+            extra_replacements={
+                "INSERT_NUMBER": insert_number,
+                "INSERT_IMAGE": self.image_href(f"Art_insert{insert_number:03}.jpg"),
+            },
         )
 
     def generate_toc_xhtml(self) -> str:
@@ -416,21 +435,25 @@ class EPUBGenerator:
             '    <item href="images/Art_copy.jpg" id="aArt_copy" media-type="image/jpeg"/>\n'
         )
 
-        text += self.replace_text(
-            '    <item href="images/Art_insert{COUNTER:03}.jpg" id="aArt_insert{COUNTER:03}" media-type="image/jpeg"/>\n',
-            self.images_config.non_filler_insert_images(),
-        )
+        # Images that are stored under another name must not be listed, since
+        # every manifest item needs its own file
+        for insert_number, _ in enumerate(
+            self.images_config.non_filler_insert_images(), start=1
+        ):
+            if self.is_stored_image(f"Art_insert{insert_number:03}.jpg"):
+                text += f'    <item href="images/Art_insert{insert_number:03}.jpg" id="aArt_insert{insert_number:03}" media-type="image/jpeg"/>\n'
 
         text += '    <item href="images/Art_line1.jpg" id="aArt_line1" media-type="image/jpeg"/>\n'
 
-        text += self.replace_text(
-            '    <item href="images/Art_chapter{CHAPTER_NUMBER:03}.jpg" id="aArt_chapter{CHAPTER_NUMBER:03}" media-type="image/jpeg"/>\n',
-            self.chapters,
-        )
+        for chapter in self.chapters:
+            if self.is_stored_image(f"Art_chapter{chapter.number:03}.jpg"):
+                text += f'    <item href="images/Art_chapter{chapter.number:03}.jpg" id="aArt_chapter{chapter.number:03}" media-type="image/jpeg"/>\n'
+
+        text += '    <item href="images/Art_sborn.jpg" id="aArt_sborn" media-type="image/jpeg"/>\n'
+        if self.is_stored_image("Art_tit.jpg"):
+            text += '    <item href="images/Art_tit.jpg" id="aArt_tit" media-type="image/jpeg"/>\n'
 
         text += (
-            '    <item href="images/Art_sborn.jpg" id="aArt_sborn" media-type="image/jpeg"/>\n'
-            '    <item href="images/Art_tit.jpg" id="aArt_tit" media-type="image/jpeg"/>\n'
             "  </manifest>\n"
             '  <spine page-progression-direction="ltr" toc="ncx">\n'
             '    <itemref idref="id_cover_xhtml" linear="yes"/>\n'
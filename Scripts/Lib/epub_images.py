@@ -0,0 +1,27 @@
+from pathlib import Path
+
+from PIL import Image
+
+EPUB_IMAGE_MAX_SIZE = 1800
+
+
+def save_epub_image(
+    img: Image.Image, output_file: Path, scale_height=True
+) -> tuple[int, int]:
+    # Scales the image down to at most `EPUB_IMAGE_MAX_SIZE` along the given
+    # axis and saves it. Returns the new size
+    if img.mode == "RGBA":
+        img = img.convert("RGB")
+
+    width, height = img.size
+
+    if scale_height:
+        ratio = EPUB_IMAGE_MAX_SIZE / height if height > EPUB_IMAGE_MAX_SIZE else 1
+    else:
+        ratio = EPUB_IMAGE_MAX_SIZE / width if width > EPUB_IMAGE_MAX_SIZE else 1
+
+    new_width = int(width * ratio)
+    new_height = int(height * ratio)
+    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    img.save(output_file, quality=100, subsampling=0)
+    return new_width, new_height
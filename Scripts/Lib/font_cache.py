@@ -0,0 +1,51 @@
+import os
+import subprocess
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+FONTS_CONF_TEMPLATE = """<?xml version="1.0"?>
+<!DOCTYPE fontconfig SYSTEM "urn:fontconfig:fonts.dtd">
+<fontconfig>
+  <dir>{fonts_dir}</dir>
+  <cachedir>{cache_dir}</cachedir>
+</fontconfig>
+"""
+
+
+def write_fonts_conf(fonts_dir: Path, cache_dir: Path) -> Path:
+    # A fontconfig configuration that only knows the bundled fonts, with its
+    # own cache, so that xelatex doesn't have to index the system fonts on a
+    # fresh machine. Returns the configuration file, for `FONTCONFIG_FILE`
+    os.makedirs(cache_dir, exist_ok=True)
+    conf_path = cache_dir / "fonts.conf"
+    conf_text = FONTS_CONF_TEMPLATE.format(
+        fonts_dir=escape(str(fonts_dir)), cache_dir=escape(str(cache_dir))
+    )
+    try:
+        if conf_path.read_text() == conf_text:
+            return conf_path
+    except OSError:
+        pass
+
+    temp_path = conf_path.with_name(f"fonts.conf.{os.getpid()}.tmp")
+    temp_path.write_text(conf_text)
+    os.replace(temp_path, conf_path)
+    return conf_path
+
+
+def prewarm_font_cache(conf_path: Path) -> bool:
+    # Builds the cache before the first xelatex pass needs it. This is cheap
+    # if it is already up to date. Returns False if `fc-cache` isn't
+    # available or failed, in which case xelatex builds the cache itself
+    env = os.environ.copy()
+    env["FONTCONFIG_FILE"] = str(conf_path)
+    try:
+        result = subprocess.run(
+            ["fc-cache"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        return False
+    return result.returncode == 0
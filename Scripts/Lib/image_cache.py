@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+USED_SUFFIX = ".used"
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def link_or_copy(source: Path, destination: Path):
+    # Never write through an existing hardlink, since that would also modify
+    # every other file sharing the inode (including cache entries)
+    destination.unlink(missing_ok=True)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class ImageCache:
+    directory: Path
+    max_size_bytes: int
+
+    def __init__(self, directory: Path, max_size_bytes: int):
+        self.directory = Path(directory)
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, source_sha256: str, **params) -> str:
+        # The key covers the exact source bytes and every parameter that
+        # influences the output, so stale entries can never be returned
+        key_data = {"source_sha256": source_sha256, **params}
+        key_json = json.dumps(key_data, sort_keys=True, default=str)
+        return hashlib.sha256(key_json.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key: str, suffix: str = ".png") -> Path:
+        return self.directory / key[:2] / (key + suffix)
+
+    def used_path(self, entry: Path) -> Path:
+        # Entries are hardlinked into build outputs, whose modification times
+        # the build journal relies on, so recency is kept on a separate file
+        return entry.with_name(entry.name + USED_SUFFIX)
+
+    def fetch(self, key: str, output_path: Path, suffix: str = ".png") -> bool:
+        entry = self.entry_path(key, suffix)
+        if not entry.exists():
+            return False
+
+        os.makedirs(output_path.parent, exist_ok=True)
+        try:
+            link_or_copy(entry, output_path)
+            # Mark the entry as recently used, for eviction
+            self.used_path(entry).touch()
+        except FileNotFoundError:
+            # Evicted by another build (e.g. a concurrent variant) since the
+            # check above, so the image is generated instead
+            return False
+        return True
+
+    def store(self, key: str, output_path: Path, suffix: str = ".png"):
+        entry = self.entry_path(key, suffix)
+        os.makedirs(entry.parent, exist_ok=True)
+        temp_entry = entry.with_name(
+            f"{entry.name}.{os.getpid()}-{threading.get_ident()}.tmp"
+        )
+        shutil.copyfile(output_path, temp_entry)
+        os.replace(temp_entry, entry)
+
+    def evict(self) -> int:
+        # Least-recently-used eviction, based on when each entry was stored or
+        # last fetched
+        entries = []
+        total_size = 0
+        for entry in self.directory.glob("*/*"):
+            if entry.suffix in (".tmp", USED_SUFFIX):
+                continue
+            stat = entry.stat()
+            try:
+                used_time = max(stat.st_mtime, self.used_path(entry).stat().st_mtime)
+            except FileNotFoundError:
+                used_time = stat.st_mtime
+            entries.append((used_time, stat.st_size, entry))
+            total_size += stat.st_size
+
+        evicted = 0
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            self.used_path(entry).unlink(missing_ok=True)
+            total_size -= size
+            evicted += 1
+
+        # Left behind by an entry that was evicted while being fetched
+        for used in self.directory.glob(f"*/*{USED_SUFFIX}"):
+            if not used.with_suffix("").exists():
+                used.unlink(missing_ok=True)
+        return evicted
@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+from PIL import Image
+
+from .image_cache import file_sha256
+
+INDEX_FILENAME = ".image-index.json"
+INDEX_VERSION = 1
+
+
+class ImageIndex:
+    # Sidecar file in an `Images/` directory that remembers the size, mode and
+    # content hash of each image. An entry is valid as long as the file's size
+    # and modification time are unchanged, so reading it only costs a `stat`
+    # New entries are only written by `flush`, once a batch of lookups is done
+    directory: Path
+    entries: dict[str, dict]
+    dirty: bool
+    lock: threading.Lock
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.entries = {}
+        self.dirty = False
+        # Images may be looked up from several threads, e.g. when validating
+        self.lock = threading.Lock()
+
+        try:
+            data = json.loads(self.index_path().read_text())
+            if data.get("version") == INDEX_VERSION:
+                self.entries = data["entries"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def index_path(self) -> Path:
+        return self.directory / INDEX_FILENAME
+
+    def entry(self, relative_path: Path) -> dict:
+        key = Path(relative_path).as_posix()
+        stat = (self.directory / relative_path).stat()
+
+        with self.lock:
+            entry = self.entries.get(key)
+        if (
+            entry is not None
+            and entry["bytes"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return entry
+
+        # The lock only guards the entries, so that headers are read in parallel
+        with Image.open(self.directory / relative_path) as img:
+            size, mode = img.size, img.mode
+        entry = {
+            "size": list(size),
+            "mode": mode,
+            "bytes": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": None,
+        }
+        with self.lock:
+            self.entries[key] = entry
+            self.dirty = True
+        return entry
+
+    def size(self, relative_path: Path) -> tuple[int, int]:
+        return tuple(self.entry(relative_path)["size"])
+
+    def mode(self, relative_path: Path) -> str:
+        return self.entry(relative_path)["mode"]
+
+    def sha256(self, relative_path: Path) -> str:
+        # Hashing reads the whole file, so it is only done when needed
+        entry = self.entry(relative_path)
+        if entry["sha256"] is None:
+            sha256 = file_sha256(self.directory / relative_path)
+            with self.lock:
+                entry["sha256"] = sha256
+                self.dirty = True
+        return entry["sha256"]
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+        self.save()
+
+    def save(self):
+        # Concurrent variants each have their own index for the same directory
+        temp_path = self.index_path().with_name(
+            f"{INDEX_FILENAME}.{os.getpid()}-{threading.get_ident()}.tmp"
+        )
+        with self.lock:
+            data = {"version": INDEX_VERSION, "entries": self.entries}
+            data_json = json.dumps(data, indent=2, sort_keys=True)
+        try:
+            temp_path.write_text(data_json)
+            os.replace(temp_path, self.index_path())
+        except OSError:
+            # The index is only an optimization, e.g. for read-only checkouts
+            temp_path.unlink(missing_ok=True)
@@ -0,0 +1,64 @@
+import unicodedata
+from typing import Callable
+
+import regex
+
+# Characters that are copied as they are if no rule matches them
+PLAIN_CHARACTERS = "\t\n\r\x20-\x7f"
+
+
+class LatexConverter:
+    # Converts text to LaTeX in a single left-to-right pass. At each position,
+    # the first of the patterns that matches there is replaced, then any
+    # character that has a replacement. This is the same order as applying
+    # each pattern in turn at every position (like `UnicodeToLatexEncoder`
+    # with a regex rule followed by a character rule), but the patterns and
+    # characters are combined into one compiled regex
+    pattern: regex.Pattern
+    replacements: dict[str, str]
+    char_replacements: dict[str, str]
+    on_unknown_char: "Callable[[str], None] | None"
+
+    def __init__(
+        self,
+        pattern_replacements: "list[tuple[str, str]]",
+        char_replacements: dict[str, str],
+        on_unknown_char: "Callable[[str], None] | None" = None,
+    ):
+        # Each pattern is its own named group, so that the match tells which
+        # one it was. The patterns must not have named groups themselves
+        self.replacements = {}
+        alternatives = []
+        for i, (pattern, replacement) in enumerate(pattern_replacements):
+            self.replacements[f"p{i}"] = replacement
+            alternatives.append(f"(?P<p{i}>{pattern})")
+
+        # Any other character that isn't plain is either replaced or unknown
+        plain_replaced = "".join(
+            regex.escape(c)
+            for c in sorted(char_replacements)
+            if regex.fullmatch(f"[{PLAIN_CHARACTERS}]", c)
+        )
+        alternatives.append(f"[^{PLAIN_CHARACTERS}]")
+        if plain_replaced:
+            alternatives.append(f"[{plain_replaced}]")
+
+        self.pattern = regex.compile("|".join(alternatives))
+        self.char_replacements = char_replacements
+        self.on_unknown_char = on_unknown_char
+
+    def _replace(self, m: regex.Match) -> str:
+        name = m.lastgroup
+        if name is not None:
+            return self.replacements[name]
+        c = m.group()
+        replacement = self.char_replacements.get(c)
+        if replacement is None:
+            if self.on_unknown_char is not None:
+                self.on_unknown_char(c)
+            return c
+        return replacement
+
+    def convert(self, text: str) -> str:
+        text = unicodedata.normalize("NFC", text)
+        return self.pattern.sub(self._replace, text)
@@ -0,0 +1,68 @@
+import os
+from pathlib import Path
+
+import regex
+from pypdf import PdfReader, PdfWriter
+
+ROMAN_NUMERALS = {"i": 1, "v": 5, "x": 10, "l": 50, "c": 100, "d": 500, "m": 1000}
+
+
+def page_count(pdf_path: Path) -> int:
+    return len(PdfReader(pdf_path).pages)
+
+
+def parse_page_label(label: str) -> tuple[str | None, int]:
+    # Returns the numbering style and value of a label, as used by
+    # `PdfWriter.set_page_label`. The style is None for other labels
+    if regex.fullmatch(r"\d+", label):
+        return "/D", int(label)
+    if regex.fullmatch(r"[ivxlcdm]+", label):
+        values = [ROMAN_NUMERALS[c] for c in label]
+        value = sum(
+            -v if i + 1 < len(values) and v < values[i + 1] else v
+            for i, v in enumerate(values)
+        )
+        return "/r", value
+    return None, 0
+
+
+def stitch_pdfs(input_paths: list[Path], output_path: Path):
+    # Concatenates the PDFs, keeping their bookmarks and page labels
+    writer = PdfWriter()
+    labels = []
+    for input_path in input_paths:
+        reader = PdfReader(input_path)
+        if not labels and reader.page_mode is not None:
+            # E.g. whether the bookmarks are shown when opening the PDF
+            writer.page_mode = reader.page_mode
+        labels.extend(reader.page_labels)
+        writer.append(reader)
+
+    # Consecutive pages with the same style and consecutive values share a
+    # label range
+    ranges = []
+    for index, label in enumerate(labels):
+        style, value = parse_page_label(label)
+        if style is None:
+            ranges.append([index, index, None, label, 0])
+            continue
+        last = ranges[-1] if ranges else None
+        if (
+            last is not None
+            and last[2] == style
+            and last[4] + (index - last[0]) == value
+        ):
+            last[1] = index
+        else:
+            ranges.append([index, index, style, None, value])
+
+    for start, end, style, prefix, value in ranges:
+        if style is None:
+            writer.set_page_label(start, end, prefix=prefix)
+        else:
+            writer.set_page_label(start, end, style, start=value)
+
+    temp_path = output_path.with_name(output_path.name + ".tmp")
+    with open(temp_path, "wb") as f:
+        writer.write(f)
+    os.replace(temp_path, output_path)
@@ -16,3 +16,7 @@ root_dir._found = None
 
 def common_dir() -> Path:
     return root_dir() / "Common"
+
+
+def cache_dir() -> Path:
+    return root_dir() / ".cache"
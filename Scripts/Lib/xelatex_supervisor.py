@@ -0,0 +1,157 @@
+import codecs
+import contextvars
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+import regex
+
+from .debug_printable import DebugPrintable
+
+# TeX prints `[<page number>` to the terminal when it ships out a page
+PAGE_PATTERN = regex.compile(r"\[-?\d+(?=[\]\s<{(])")
+FATAL_MARKERS = ["Emergency stop", "Fatal error occurred", "==> Fatal error"]
+EXCERPT_LINES = 12
+
+
+class XelatexResult(DebugPrintable):
+    returncode: int
+    pages: int
+    seconds: float
+    fatal: bool
+    # Log excerpts of the errors, in order
+    errors: list[str]
+
+    def pages_per_second(self) -> float:
+        return self.pages / self.seconds if self.seconds > 0 else 0.0
+
+
+class XelatexProcess:
+    # Runs xelatex (in `nonstopmode` or `scrollmode`, so that it writes to the
+    # terminal) and follows its output while it runs, counting the pages it
+    # ships out and watching for fatal errors
+    args: list[str]
+    env: dict[str, str]
+    cwd: Path
+    log_file: Path
+    echo: bool
+    on_progress: "Callable[[int, float], None] | None"
+    progress_interval: float
+    pages: int
+    fatal: bool
+    process: subprocess.Popen
+    reader: threading.Thread
+    start_time: float
+    end_time: float
+
+    def __init__(
+        self,
+        args: list[str],
+        env: dict[str, str],
+        cwd: Path,
+        log_file: Path,
+        echo=False,
+        on_progress: "Callable[[int, float], None] | None" = None,
+        progress_interval=5.0,
+    ):
+        self.args = args
+        self.env = env
+        self.cwd = cwd
+        self.log_file = log_file
+        self.echo = echo
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+        self.pages = 0
+        self.fatal = False
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.process = subprocess.Popen(
+            args=self.args,
+            env=self.env,
+            cwd=str(self.cwd),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        # `on_progress` runs in the context of the caller, e.g. to log like it
+        self.reader = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(self._read_output,),
+            daemon=True,
+        )
+        self.reader.start()
+
+    def _read_output(self):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = ""
+        last_progress = self.start_time
+        while chunk := self.process.stdout.read1(1 << 16):
+            text = decoder.decode(chunk)
+            if self.echo:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+
+            pending += text
+            end = 0
+            for match in PAGE_PATTERN.finditer(pending):
+                self.pages += 1
+                end = match.end()
+            if any(marker in pending for marker in FATAL_MARKERS):
+                self.fatal = True
+            # Keep enough to find a marker that is split across chunks
+            pending = pending[max(end, len(pending) - 64) :]
+
+            now = time.perf_counter()
+            if (
+                self.on_progress is not None
+                and now - last_progress >= self.progress_interval
+            ):
+                self.on_progress(self.pages, now - self.start_time)
+                last_progress = now
+        # The output ends when xelatex exits, which may be long before `wait`
+        self.end_time = time.perf_counter()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        self.reader.join()
+
+    def wait(self) -> XelatexResult:
+        returncode = self.process.wait()
+        self.reader.join()
+
+        result = XelatexResult()
+        result.returncode = returncode
+        result.pages = self.pages
+        result.seconds = self.end_time - self.start_time
+        result.errors = log_errors(self.log_file)
+        # Without any page, a failed run can't have produced anything useful
+        result.fatal = self.fatal or (returncode != 0 and self.pages == 0)
+        return result
+
+
+def log_errors(log_file: Path) -> list[str]:
+    # Each TeX error starts with `! ` and ends with the line of the input it
+    # happened on, `l.<line number> <text before the error>`, followed by the
+    # rest of that line
+    try:
+        lines = log_file.read_text(errors="replace").splitlines()
+    except OSError:
+        return []
+
+    excerpts = []
+    for i, line in enumerate(lines):
+        if not line.startswith("! "):
+            continue
+        excerpt = lines[i : i + EXCERPT_LINES]
+        for j, excerpt_line in enumerate(excerpt):
+            if regex.match(r"l\.\d+", excerpt_line):
+                excerpt = excerpt[: j + 2]
+                break
+        excerpts.append(os.linesep.join(excerpt))
+    return excerpts
@@ -0,0 +1,102 @@
+import argparse
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+from Lib.bleed_fill import BLEED_FILL_STRATEGIES, fill_bleed
+from Lib.config import GlobalImagesConfig, parse_image_config
+from Lib.project_dirs import common_dir, root_dir
+from output_tex import INPAINT_RADIUS, crop_and_pad_mat, length_to_inches
+
+
+def padding_mask(shape, padding_lrtb):
+    l, r, t, b = (max(0, p) for p in padding_lrtb)
+    h, w = shape[:2]
+    mask = np.ones((h, w), dtype=bool)
+    mask[t : h - b, l : w - r] = False
+    return mask
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmark_bleed_fill",
+        description="Compares the speed and quality of the bleed fill strategies on the images of the given volumes. The error is measured on the padded pixels only, against the full-canvas TELEA inpainting.",
+    )
+    parser.add_argument(
+        "volume_dirs",
+        nargs="*",
+        help="Volume directories to benchmark. Defaults to all volumes.",
+    )
+    parser.add_argument(
+        "-b",
+        "--bleed-size",
+        default="0.125in",
+        type=str,
+        help="Bleed size to pad the images for.",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Print results per image."
+    )
+    args = parser.parse_args()
+
+    bleed_size = length_to_inches(args.bleed_size)
+    volume_dirs = [Path(d) for d in args.volume_dirs] or sorted(
+        (root_dir() / "Volumes").glob("Volume_*")
+    )
+
+    configs = [parse_image_config(d / "Images") for d in volume_dirs]
+    configs.append(
+        GlobalImagesConfig.from_file(common_dir() / "TeX" / "Images" / "config.yaml")
+    )
+
+    times = {strategy: [] for strategy in BLEED_FILL_STRATEGIES}
+    errors = {strategy: [] for strategy in BLEED_FILL_STRATEGIES}
+
+    for config in configs:
+        for image_info in config.all_images_iter():
+            path = image_info.absolute_image_path()
+            if not path.exists():
+                print(f"Skipping missing image {path}")
+                continue
+
+            l, r, t, b = padding_lrtb = image_info.padding_lrtb(bleed_size)
+            img = crop_and_pad_mat(cv2.imread(str(path)), [(t, b), (l, r)])
+            mask = padding_mask(img.shape, padding_lrtb)
+            if not mask.any():
+                continue
+
+            reference = fill_bleed(
+                img, padding_lrtb, "telea", INPAINT_RADIUS, "full"
+            ).astype(np.float32)
+
+            for strategy in BLEED_FILL_STRATEGIES:
+                start = time.perf_counter()
+                filled = fill_bleed(img, padding_lrtb, strategy, INPAINT_RADIUS)
+                elapsed = time.perf_counter() - start
+
+                error = np.abs(filled[mask].astype(np.float32) - reference[mask])
+                times[strategy].append(elapsed)
+                errors[strategy].append(float(error.mean()))
+
+                if args.verbose:
+                    print(
+                        f"{path.relative_to(root_dir())} {strategy:>15}: "
+                        + f"{elapsed * 1000:8.1f} ms, mean abs error {error.mean():6.2f}"
+                    )
+
+    print(
+        f"{'strategy':>15} {'images':>6} {'ms/image':>9} {'mean err':>9} {'max err':>8}"
+    )
+    for strategy in BLEED_FILL_STRATEGIES:
+        if not times[strategy]:
+            continue
+        print(
+            f"{strategy:>15} {len(times[strategy]):>6} "
+            + f"{np.mean(times[strategy]) * 1000:>9.1f} "
+            + f"{np.mean(errors[strategy]):>9.2f} {np.max(errors[strategy]):>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
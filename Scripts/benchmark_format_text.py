@@ -0,0 +1,172 @@
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+
+import regex
+from Lib.config import parse_book_config
+from Lib.project_dirs import root_dir
+from output_tex import format_paragraphs, format_text
+from pylatexenc.latexencode import (
+    RULE_REGEX,
+    UnicodeToLatexConversionRule,
+    UnicodeToLatexEncoder,
+)
+
+# Covers every tag, span and ellipsis rule, next to words and other tags, as
+# well as characters with and without a LaTeX replacement
+SYNTHETIC_TEXT = """\
+"Wait<i>...</i>" she said… <em>and</em>...then <b>left</b>…<strong>now</strong>.
+A <u>line</u>, <code>x_y & 100% $5 #1 ^ ~ {a} \\b</code><br>next<br/>last<br />end.
+
+<span class="v-centered-page">Centered… <i>text</i></span>
+
+<span class="page-break"/><span class="page-break" />
+Wi-widow — “quoted” ‘single’ move on ’em, café, naïve, 1 < 2 > 0.
+<unknown tag>... ...word... word...<i>word</i> …
+
+* * *
+
+After the break. Control\x07character and ☃ snowman.
+"""
+
+
+def reference_latex_converter() -> UnicodeToLatexEncoder:
+    # The rules `format_text` used to run through pylatexenc, one regex at a
+    # time at each position
+    after_wchar = r"(?<=\w(?:<[^<>]+>)*)"
+    before_wchar = r"(?=(?:<[^<>]+>)*\w)"
+
+    def span_replacement(start_command: str, end_command="") -> str:
+        return (
+            R"\\begin{SpanEnv}\\renewcommand{\\SpanEnvClose}{"
+            + end_command
+            + "}"
+            + start_command
+        )
+
+    regex_replacements = {
+        rf"{after_wchar}(?:(?:\.\.\.)|(?:…)){before_wchar}": r"{\\EllipsisSplittable}",
+        r"(?:(?:\.\.\.)|(?:…))": r"{\\Ellipsis}",
+        rf"</span>": r"\\end{SpanEnv}",
+        rf'<span class="v-centered-page">': span_replacement(
+            r"\\newpage\\hspace{0pt}\\vfill ", r" \\vfill\\hspace{0pt}\\newpage"
+        ),
+        rf'<span class="page-break"[ ]?/>': r"\\newpage",
+        r"<i>": r"\\textit{",
+        r"</i>": r"}",
+        r"<em>": r"\\textit{",
+        r"</em>": r"}",
+        r"<u>": r"\\ul{",
+        r"</u>": r"}",
+        r"<code>": r"\\texttt{",
+        r"</code>": r"}",
+        r"<b>": r"\\textbf{",
+        r"</b>": r"}",
+        r"<strong>": r"\\textbf{",
+        r"</strong>": r"}",
+        r"<br(?:[ ]?/)?>": r"\\",
+    }
+
+    conversion_rules = [
+        UnicodeToLatexConversionRule(
+            RULE_REGEX,
+            [(regex.compile(k), v) for k, v in regex_replacements.items()],
+            replacement_latex_protection="none",
+        ),
+        "defaults",
+    ]
+    return UnicodeToLatexEncoder(
+        conversion_rules=conversion_rules, replacement_latex_protection="braces-all"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmark_format_text",
+        description="Checks that the text conversion of `output_tex.py` produces exactly the same LaTeX as the previous pylatexenc-based conversion, on the texts of the given volumes and on a synthetic text that covers every rule. Then compares their throughput, and measures the conversion of a stress corpus of the volumes' texts repeated.",
+    )
+    parser.add_argument(
+        "volume_dirs",
+        nargs="*",
+        help="Volume directories to convert. Defaults to all volumes.",
+    )
+    parser.add_argument(
+        "-s",
+        "--scale",
+        default=10,
+        type=int,
+        help="Size of the stress corpus, as a multiple of the volumes' texts.",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        default=3,
+        type=int,
+        help="Number of timed runs per converter. The fastest one is reported.",
+    )
+    args = parser.parse_args()
+
+    # The synthetic text's unknown characters would be warned about in every run
+    logging.disable(logging.WARNING)
+
+    volume_dirs = [Path(d) for d in args.volume_dirs] or sorted(
+        (root_dir() / "Volumes").glob("Volume_*")
+    )
+    texts = [SYNTHETIC_TEXT]
+    for volume_dir in volume_dirs:
+        book_config = parse_book_config(volume_dir.absolute())
+        if book_config is None:
+            continue
+        for chapter in book_config.chapters:
+            for part in chapter.parts:
+                texts.append(part.text_filepath().read_text())
+    stress_texts = texts * args.scale
+
+    reference_converter = reference_latex_converter()
+
+    def reference_format_text(text: str) -> str:
+        return format_paragraphs(reference_converter.unicode_to_latex(text))
+
+    mismatches = 0
+    for i, text in enumerate(texts):
+        expected = reference_format_text(text)
+        actual = format_text.__wrapped__(text)
+        if actual != expected:
+            position = next(
+                (j for j, (a, b) in enumerate(zip(actual, expected)) if a != b),
+                min(len(actual), len(expected)),
+            )
+            print(f"Text {i}: output differs at character {position}:")
+            print(f"  expected: {expected[position - 40 : position + 40]!r}")
+            print(f"    actual: {actual[position - 40 : position + 40]!r}")
+            mismatches += 1
+    print(f"Checked {len(texts)} texts, {mismatches} mismatch(es)")
+
+    # The pylatexenc conversion is too slow to time on the stress corpus
+    runs = [
+        ("volumes", texts, "pylatexenc", reference_format_text),
+        ("volumes", texts, "compiled", format_text.__wrapped__),
+        (f"stress ({args.scale}x)", stress_texts, "compiled", format_text.__wrapped__),
+    ]
+    print(f"{'corpus':>14} {'converter':>10} {'MiB':>7} {'time (s)':>9} {'MiB/s':>8}")
+    for corpus_name, corpus, converter_name, convert in runs:
+        size = sum(len(text.encode("utf-8")) for text in corpus) / (1 << 20)
+        elapsed = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for text in corpus:
+                convert(text)
+            elapsed = min(elapsed, time.perf_counter() - start)
+        print(
+            f"{corpus_name:>14} {converter_name:>10} {size:>7.2f} "
+            + f"{elapsed:>9.2f} {size / elapsed:>8.2f}"
+        )
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import argparse
+from pathlib import Path
+
+from Lib.config import parse_book_config, parse_image_config
+from output_tex import (
+    IMAGE_ENCODINGS,
+    ImageSettings,
+    convert_book,
+    get_xelatex_command,
+    length_to_inches,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmark_image_encoding",
+        description="Builds a volume once per intermediate image encoding, and compares the image generation time, the time of the xelatex pass that embeds the images, and the size of the resulting PDF.",
+    )
+    parser.add_argument("input_dir", help="Volume directory to build.")
+    parser.add_argument(
+        "output_dir",
+        help="Directory for the builds. Each encoding is built in its own subdirectory.",
+    )
+    parser.add_argument(
+        "encodings",
+        nargs="*",
+        help=f"Encodings to compare. Defaults to all of: {', '.join(IMAGE_ENCODINGS)}.",
+    )
+    parser.add_argument(
+        "-b",
+        "--bleed-size",
+        default="0.125in",
+        type=str,
+        help="Bleed size to pad the images for.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        help="Number of processes used for image generation.",
+    )
+    args = parser.parse_args()
+
+    encodings = args.encodings or list(IMAGE_ENCODINGS)
+    for encoding in encodings:
+        if encoding not in IMAGE_ENCODINGS:
+            parser.error(f"unknown encoding '{encoding}'")
+
+    book_config = parse_book_config(Path(args.input_dir).absolute())
+    if book_config is None:
+        return
+    images_config = parse_image_config(book_config.directory / "Images")
+    xelatex_command = get_xelatex_command()
+
+    results = {}
+    for encoding in encodings:
+        output_dir = (Path(args.output_dir) / encoding).absolute()
+        work_dir = output_dir / "WorkDir" / "TeX"
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+        # No image cache and no build journal, so that every encoding pays for
+        # its image generation and both passes, even when rerun
+        timings = convert_book(
+            book_config,
+            images_config,
+            "",
+            output_dir,
+            work_dir,
+            length_to_inches(args.bleed_size),
+            xelatex_command_line=xelatex_command,
+            jobs=args.jobs,
+            image_settings=ImageSettings(encoding=encoding),
+            fresh=True,
+        )
+        pdf_size = sum(p.stat().st_size for p in output_dir.glob("*.pdf"))
+        results[encoding] = (timings, pdf_size)
+
+    print(f"{'encoding':>12} {'images (s)':>10} {'2nd pass (s)':>12} {'PDF (MiB)':>9}")
+    for encoding, (timings, pdf_size) in results.items():
+        print(
+            f"{encoding:>12} {timings['images']:>10.1f} "
+            + f"{timings['second pass']:>12.1f} {pdf_size / (1 << 20):>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
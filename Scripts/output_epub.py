@@ -15,6 +15,7 @@ from PIL import Image
 from argparse_color_formatter import ColorHelpFormatter
 from Lib.config import (
     Book,
+    ImageInfo,
     ImagesConfig,
     SingleImage,
     parse_book_config,
@@ -22,6 +23,7 @@ from Lib.config import (
 )
 from Lib.project_dirs import common_dir
 from Lib.epub_generation import EPUBGenerator
+from Lib.epub_images import save_epub_image
 
 formatter = colorlog.ColoredFormatter(
     "%(log_color)s%(levelname)s: %(message)s",
@@ -48,16 +50,21 @@ def convert_book(
     image_config: ImagesConfig,
     output_dir: Path,
     work_dir: Path,
+    images_processed=False,
 ):
+    # With `images_processed`, the work directory has already been prepared
+    # and the images written, e.g. by `output_release.py`
     text_output_directory = work_dir / "OEBPS"
     images_output_directory = work_dir / "OEBPS" / "images"
-    if os.path.exists(work_dir):
-        shutil.rmtree(work_dir)
-    shutil.copytree(common_dir() / "ePub", work_dir)
+    if not images_processed:
+        prepare_work_dir(work_dir)
     output_stem = f"WorldEnd2_v{book_config.volume:02}"
 
     output_file = output_dir / (output_stem + ".epub")
-    process_images(image_config, images_output_directory, book_config.isbn)
+    if not images_processed:
+        generator.image_files = process_images(
+            image_config, images_output_directory, book_config.isbn
+        )
     convert_md_to_html(generator, book_config, image_config, text_output_directory)
     logger.info("==Zipping work directory into EPUB==")
     convert_zip_to_epub(output_file, work_dir)
@@ -66,21 +73,8 @@ def convert_book(
 
 def resize_image(input_file: Path, output_file: Path, scale_height=True):
     img = Image.open(input_file)
-
-    if img.mode == "RGBA":
-        img = img.convert("RGB")
-
     width, height = img.size
-
-    if scale_height:
-        ratio = 1800 / height if height > 1800 else 1
-    else:
-        ratio = 1800 / width if width > 1800 else 1
-
-    new_width = int(width * ratio)
-    new_height = int(height * ratio)
-    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    img.save(output_file, quality=100, subsampling=0)
+    new_width, new_height = save_epub_image(img, output_file, scale_height)
     logger.debug(
         f"{Path(input_file.parent.name) / input_file.name} ({width}x{height} => {new_width}x{new_height})"
     )
@@ -151,34 +145,82 @@ def convert_md_to_html(
     )
 
 
-def process_images(images_config: ImagesConfig, output_dir: Path, isbn: str):
+def prepare_work_dir(work_dir: Path, kept_images: "list[str] | None" = None):
+    # `kept_images` are the names of images of the previous build to keep
+    # as they are, e.g. for the build journal of `output_release.py`
+    images_dir = work_dir / "OEBPS" / "images"
+    kept_dir = work_dir.with_name(f"{work_dir.name}.kept-images")
+    if os.path.exists(kept_dir):
+        shutil.rmtree(kept_dir)
+    os.makedirs(kept_dir)
+    for name in kept_images or []:
+        if os.path.exists(images_dir / name):
+            os.replace(images_dir / name, kept_dir / name)
+
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    shutil.copytree(common_dir() / "ePub", work_dir)
+
+    for name in os.listdir(kept_dir):
+        os.replace(kept_dir / name, images_dir / name)
+    os.rmdir(kept_dir)
+
+
+def process_images(
+    images_config: ImagesConfig, output_dir: Path, isbn: str
+) -> dict[str, str]:
+    # Returns the file names of images that are identical to an earlier one,
+    # mapped to the name of the file that is stored instead
     os.makedirs(output_dir, exist_ok=True)
 
     logger.info("==Resizing Images==")
 
+    stored_images, image_files = epub_images(images_config, isbn)
+    for img_info, name in stored_images:
+        resize_image(
+            img_info.absolute_image_path(),
+            output_dir / name,
+            isinstance(img_info, SingleImage),
+        )
+
+    return image_files
+
+
+def epub_images(
+    images_config: ImagesConfig, isbn: str
+) -> "tuple[list[tuple[ImageInfo, str]], dict[str, str]]":
+    # Returns the images to store in the package with their file names, and
+    # the names of the images that are identical to a stored one, mapped to
+    # the stored name
+    images = []
     if images_config.front_cover:
-        img_info = images_config.front_cover
-        image_path = img_info.absolute_image_path()
-        output_path = output_dir / f"{isbn}.jpg"
-        resize_image(image_path, output_path, isinstance(img_info, SingleImage))
+        images.append((images_config.front_cover, f"{isbn}.jpg"))
 
     for insert_image_number, img_info in enumerate(
         images_config.non_filler_insert_images(), start=1
     ):
-        image_path = img_info.absolute_image_path()
-        output_path = output_dir / f"Art_insert{insert_image_number:03}.jpg"
-        resize_image(image_path, output_path, isinstance(img_info, SingleImage))
+        images.append((img_info, f"Art_insert{insert_image_number:03}.jpg"))
 
     if images_config.titlepage:
-        img_info = images_config.titlepage
-        image_path = img_info.absolute_image_path()
-        output_path = output_dir / "Art_tit.jpg"
-        resize_image(image_path, output_path, isinstance(img_info, SingleImage))
+        images.append((images_config.titlepage, "Art_tit.jpg"))
 
     for chapter_number, img_info in images_config.chapter_images.items():
-        image_path = img_info.absolute_image_path()
-        output_path = output_dir / f"Art_chapter{chapter_number:03}.jpg"
-        resize_image(image_path, output_path, isinstance(img_info, SingleImage))
+        images.append((img_info, f"Art_chapter{chapter_number:03}.jpg"))
+
+    stored_names = {}
+    stored_images = []
+    image_files = {}
+    for img_info, name in images:
+        key = (img_info.sha256, isinstance(img_info, SingleImage))
+        if key in stored_names:
+            logger.debug(f"{name} is identical to {stored_names[key]}")
+            image_files[name] = stored_names[key]
+            continue
+        stored_names[key] = name
+        stored_images.append((img_info, name))
+    images_config.index.flush()
+
+    return stored_images, image_files
 
 
 def main():
@@ -0,0 +1,69 @@
+import logging
+import os
+from pathlib import Path
+
+from Lib.config import SingleImage, parse_book_config, parse_image_config
+from Lib.epub_generation import EPUBGenerator
+import output_epub
+import output_tex
+
+
+def main():
+    parser = output_tex.argument_parser(
+        prog="output_release",
+        description="Converts the input .md files to both a .pdf and an .epub file, decoding each source image only once for both.",
+    )
+    args = parser.parse_args()
+
+    if args.verbose:
+        output_epub.logger.setLevel(logging.DEBUG)
+
+    book_config = parse_book_config(Path(args.input_dir).absolute())
+    if book_config is None:
+        return
+    images_config = parse_image_config(book_config.directory / "Images")
+
+    output_dir = Path(args.output_dir).absolute()
+    os.makedirs(output_dir, exist_ok=True)
+    output_dir = output_dir.resolve()
+
+    stored_images, image_files = output_epub.epub_images(
+        images_config, book_config.isbn
+    )
+
+    # Without image generation (or with only some of the images, for a
+    # preview) the EPUB images are written the usual way
+    images_processed = not args.skip_image_generation and args.only_chapter is None
+
+    # The images of the last build are kept, so that the images stage can be
+    # skipped if they are unchanged
+    epub_work_dir = output_dir / "WorkDir" / "ePub"
+    output_epub.prepare_work_dir(
+        epub_work_dir,
+        [name for _, name in stored_images] if images_processed else None,
+    )
+    epub_images_dir = epub_work_dir / "OEBPS" / "images"
+    epub_outputs = {}
+    if images_processed:
+        for img_info, name in stored_images:
+            epub_outputs.setdefault(img_info.absolute_image_path(), []).append(
+                (epub_images_dir / name, isinstance(img_info, SingleImage))
+            )
+
+    output_tex.convert_book_from_args(args, epub_outputs)
+
+    generator = EPUBGenerator.from_book_config(book_config, images_config)
+    if images_processed:
+        generator.image_files = image_files
+    output_epub.convert_book(
+        generator,
+        book_config,
+        images_config,
+        output_dir,
+        epub_work_dir,
+        images_processed,
+    )
+
+
+if __name__ == "__main__":
+    main()
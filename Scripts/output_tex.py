@@ -1,12 +1,24 @@
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import hashlib
 import itertools
+import json
 import logging
+import math
+import multiprocessing
 import os
 import shlex
 import shutil
 import subprocess
 import sys
+import threading
+import time
 from pathlib import Path, PurePosixPath
+from typing import Callable
 
 import colorlog
 import colors
@@ -27,15 +39,25 @@ from Lib.config import (
     parse_book_config,
     parse_image_config,
 )
-from Lib.project_dirs import common_dir
+from Lib.image_cache import ImageCache, file_sha256, link_or_copy
+from Lib.latex_converter import LatexConverter
+from Lib.build_journal import BuildJournal, file_fingerprints
+from Lib.font_cache import prewarm_font_cache, write_fonts_conf
+from Lib.pdf_stitching import page_count, stitch_pdfs
+from Lib.xelatex_supervisor import XelatexProcess, XelatexResult
+from Lib.bleed_fill import (
+    BLEED_FILL_STRATEGIES,
+    INPAINT_METHODS,
+    fill_bleed,
+    inpaint_bands,
+)
+from Lib.debug_printable import DebugPrintable
+from Lib.epub_images import save_epub_image
+from Lib.project_dirs import cache_dir, common_dir
 from Lib.git_info import curr_git_commit_hash_with_dirty
 
 from PIL import Image, ImageDraw, ImageFont
-from pylatexenc.latexencode import (
-    RULE_REGEX,
-    UnicodeToLatexConversionRule,
-    UnicodeToLatexEncoder,
-)
+from pylatexenc.latexencode import get_builtin_uni2latex_dict
 
 formatter = colorlog.ColoredFormatter(
     "%(log_color)s%(levelname)s: %(message)s",
@@ -55,10 +77,137 @@ logger = logging.getLogger(__name__)
 logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
+
+class VariantBuild:
+    # A variant built concurrently with others (see `--variants`). Everything
+    # logged while building it is prefixed with its name, and its xelatex
+    # passes are killed when it is cancelled because another variant failed
+    name: str
+    cancelled: bool
+    processes: "set[XelatexProcess]"
+    lock: threading.Lock
+
+    def __init__(self, name: str):
+        self.name = name
+        self.cancelled = False
+        self.processes = set()
+        self.lock = threading.Lock()
+
+    def add_process(self, process: "XelatexProcess"):
+        with self.lock:
+            self.processes.add(process)
+            if not self.cancelled:
+                return
+        process.kill()
+
+    def remove_process(self, process: "XelatexProcess"):
+        with self.lock:
+            self.processes.discard(process)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            processes = list(self.processes)
+        for process in processes:
+            process.kill()
+
+
+# The variant that the current thread builds, if any
+current_variant: "contextvars.ContextVar[VariantBuild | None]" = contextvars.ContextVar(
+    "current_variant", default=None
+)
+
+
+class VariantLogFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        variant = current_variant.get()
+        if variant is not None:
+            record.msg = f"[{variant.name}] {record.msg}"
+        return True
+
+
+logger.addFilter(VariantLogFilter())
+
 ureg = pint.UnitRegistry()
 
-xelatex_default_miktex = "xelatex -interaction={MODE} -enable-installer -output-directory={OUTPUT_DIRECTORY} -job-name={JOB_NAME} {TEX_FILE}"
-xelatex_default_texlive = "xelatex -interaction={MODE} -output-directory={OUTPUT_DIRECTORY} -jobname={JOB_NAME} {TEX_FILE}"
+xelatex_default_miktex = "xelatex -interaction={MODE} -enable-installer -undump={FORMAT} -output-directory={OUTPUT_DIRECTORY} -job-name={JOB_NAME} {TEX_FILE}"
+xelatex_default_texlive = "xelatex -interaction={MODE} -fmt={FORMAT} -output-directory={OUTPUT_DIRECTORY} -jobname={JOB_NAME} {TEX_FILE}"
+
+# Commands that precompile the static preamble (up to `\endofdump`) of a TeX
+# file into a format file with mylatexformat
+xelatex_format_miktex = "xelatex -ini -interaction=batchmode -enable-installer -undump=xelatex -output-directory={OUTPUT_DIRECTORY} -job-name={JOB_NAME} mylatexformat.ltx {TEX_FILE}"
+xelatex_format_texlive = 'xelatex -ini -interaction=batchmode -output-directory={OUTPUT_DIRECTORY} -jobname={JOB_NAME} "&xelatex" mylatexformat.ltx {TEX_FILE}'
+XELATEX_FORMAT_COMMANDS = {
+    xelatex_default_miktex: xelatex_format_miktex,
+    xelatex_default_texlive: xelatex_format_texlive,
+}
+END_OF_DUMP = R"\csname endofdump\endcsname"
+# Concurrently built variants share the format and the font configuration
+xelatex_format_lock = threading.Lock()
+font_config_lock = threading.Lock()
+
+# Bump this whenever a change to the image generation code changes its output,
+# so that previously cached images are not reused
+IMAGE_PIPELINE_VERSION = 1
+INPAINT_RADIUS = 2
+
+# File suffix and `cv2.imwrite` parameters of the generated images.
+# xdvipdfmx embeds JPEG files as-is, but has to decode and re-compress PNG files
+IMAGE_ENCODINGS = {
+    "png": (".png", []),
+    "png-fast": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+    "png-archival": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 9]),
+    "jpeg": (
+        ".jpg",
+        [
+            cv2.IMWRITE_JPEG_QUALITY,
+            95,
+            cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+            cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444,
+        ],
+    ),
+}
+
+# Interpolation used when downsampling images, e.g. for the screen profile
+RESAMPLE_FILTERS = {
+    "area": cv2.INTER_AREA,
+    "lanczos": cv2.INTER_LANCZOS4,
+    "cubic": cv2.INTER_CUBIC,
+    "linear": cv2.INTER_LINEAR,
+}
+
+TOC_PAGE_NUMBER_SIZE = 42
+
+# Upper bound on the xelatex passes when rerunning until the .aux file is stable
+MAX_XELATEX_PASSES = 5
+# Seconds between progress reports of a running xelatex pass
+XELATEX_PROGRESS_INTERVAL = 10.0
+
+# Rough upper bound of the memory used by `cv2.inpaint` per pixel of a window,
+# including the window itself, the mask and OpenCV's internal buffers
+INPAINT_BYTES_PER_PIXEL = 32
+MIN_INPAINT_WINDOW_PIXELS = 1 << 16
+
+
+PRINT_MODE_OPTIONS = {
+    "bleed_size": "0.125in",
+    "gutter_size": "0.15in",
+    "no_front_cover": True,
+    "no_back_cover": True,
+}
+DIGITAL_OPTIONS = {
+    "bleed_size": "0.0in",
+    "gutter_size": "0.0in",
+    "no_front_cover": False,
+    "no_back_cover": False,
+}
+# Options of each variant for `--variants`, overriding the command line
+VARIANTS = {
+    "print": {**PRINT_MODE_OPTIONS, "profile": "full"},
+    "digital": {**DIGITAL_OPTIONS, "profile": "full"},
+    "screen": {**DIGITAL_OPTIONS, "profile": "screen"},
+    "draft": {**DIGITAL_OPTIONS, "profile": "draft"},
+}
 
 
 def get_xelatex_command() -> str:
@@ -83,6 +232,139 @@ def get_xelatex_command() -> str:
         sys.exit(1)
 
 
+def xelatex_args(command_line: str, format_path: Path | None = None, **kwargs):
+    args = []
+    for arg in shlex.split(command_line):
+        if "{FORMAT}" in arg and format_path is None:
+            # Without a format, the option that loads it is left out
+            continue
+        args.append(arg.format(FORMAT=format_path, **kwargs))
+    return args
+
+
+def prepare_font_config() -> Path:
+    # Returns the fontconfig configuration for xelatex (see `write_fonts_conf`).
+    # Its cache is only prewarmed once per process, since variants share it
+    with font_config_lock:
+        conf_path = write_fonts_conf(
+            common_dir() / "TeX" / "Fonts", cache_dir() / "fonts"
+        )
+        if not prepare_font_config.prewarmed:
+            start_time = time.perf_counter()
+            if prewarm_font_cache(conf_path):
+                logger.debug(
+                    "Prewarmed the font cache in "
+                    + f"{time.perf_counter() - start_time:.1f}s"
+                )
+            else:
+                logger.debug("Could not run fc-cache, xelatex builds the font cache")
+            prepare_font_config.prewarmed = True
+        return conf_path
+
+
+prepare_font_config.prewarmed = False
+
+
+def prepare_xelatex_format(
+    xelatex_command_line: str,
+    main_tex_file: Path,
+    format_dir: Path,
+    env: "dict[str, str] | None" = None,
+) -> Path | None:
+    with xelatex_format_lock:
+        return _prepare_xelatex_format(
+            xelatex_command_line, main_tex_file, format_dir, env
+        )
+
+
+def _prepare_xelatex_format(
+    xelatex_command_line: str,
+    main_tex_file: Path,
+    format_dir: Path,
+    env: "dict[str, str] | None" = None,
+) -> Path | None:
+    # Returns the format file with the precompiled static preamble of
+    # `main_tex_file`, building it if needed. Returns None if the command line
+    # doesn't load a format or the format can't be built, in which case
+    # xelatex just processes the whole preamble every time
+    if "{FORMAT}" not in xelatex_command_line:
+        return None
+    format_command_line = XELATEX_FORMAT_COMMANDS.get(
+        xelatex_command_line, xelatex_format_texlive
+    )
+
+    preamble, end_of_dump, _ = main_tex_file.read_text().partition(END_OF_DUMP)
+    if not end_of_dump:
+        logger.warning(f"No {END_OF_DUMP} in {main_tex_file.name}, not using a format")
+        return None
+
+    # The format is only valid for the TeX distribution that built it
+    try:
+        xelatex_version = subprocess.check_output(
+            [shlex.split(format_command_line)[0], "--version"],
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f"Could not get the xelatex version, not using a format: {e}")
+        return None
+
+    key_data = {
+        "preamble": preamble,
+        "xelatex_version": xelatex_version,
+        "command_line": format_command_line,
+    }
+    key_json = json.dumps(key_data, sort_keys=True)
+    key = hashlib.sha256(key_json.encode("utf-8")).hexdigest()
+    format_name = f"{main_tex_file.stem}-{key[:16]}"
+    format_path = format_dir / f"{format_name}.fmt"
+    failed_path = format_dir / f"{format_name}.failed"
+    log_path = format_dir / f"{format_name}.log"
+    if format_path.exists():
+        logger.debug(f"Using the xelatex format {format_path}")
+        return format_path
+    # A format that failed to build would fail again with the same key
+    if failed_path.exists():
+        logger.debug(f"The xelatex format failed to build before, see {log_path}")
+        return None
+
+    logger.info("==Precompiling the preamble into an xelatex format==")
+    os.makedirs(format_dir, exist_ok=True)
+    # Build under a temporary name, so that concurrent builds never load a
+    # partially written format
+    temp_name = f"{format_name}-{os.getpid()}"
+    args = xelatex_args(
+        format_command_line,
+        OUTPUT_DIRECTORY=format_dir,
+        JOB_NAME=temp_name,
+        TEX_FILE=main_tex_file.name,
+    )
+    logger.debug(" ".join(args))
+    result = subprocess.run(
+        args=args,
+        env=env,
+        cwd=str(main_tex_file.parent),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    temp_format_path = format_dir / f"{temp_name}.fmt"
+    temp_log_path = format_dir / f"{temp_name}.log"
+    if result.returncode != 0 or not temp_format_path.exists():
+        temp_format_path.unlink(missing_ok=True)
+        if temp_log_path.exists():
+            os.replace(temp_log_path, log_path)
+        failed_path.touch()
+        logger.warning(
+            "Could not build the xelatex format, compiling without it. "
+            + f"See {log_path}"
+        )
+        return None
+
+    os.replace(temp_format_path, format_path)
+    temp_log_path.unlink(missing_ok=True)
+    return format_path
+
+
 def in_curlies(s):
     return "{" + str(s) + "}"
 
@@ -100,6 +382,14 @@ def length_to_inches(length: str) -> float:
     return quantity.to("inch").magnitude
 
 
+def size_to_bytes(size: str) -> int:
+    quantity = ureg(size)
+    if isinstance(quantity, (int, float)):
+        logger.error(f"Invalid size `{quantity}`. Perhaps you are missing a unit?")
+        sys.exit(1)
+    return int(quantity.to("byte").magnitude)
+
+
 def env_path_prepend(s_old: str, *args) -> str:
     l = list(args)
     if s_old and not s_old.isspace():
@@ -109,7 +399,7 @@ def env_path_prepend(s_old: str, *args) -> str:
     return os.pathsep.join(str(x) for x in l)
 
 
-def get_latex_converter() -> UnicodeToLatexEncoder:
+def get_latex_converter() -> LatexConverter:
     if not hasattr(get_latex_converter, "converter"):
         # Check whether this character is preceded/followed by a word character
         # (\w), possibly with some HTML tags in between
@@ -121,58 +411,83 @@ def get_latex_converter() -> UnicodeToLatexEncoder:
         # enclose something between the start and end command
         def span_replacement(start_command: str, end_command="") -> str:
             return (
-                R"\\begin{SpanEnv}\\renewcommand{\\SpanEnvClose}{"
+                R"\begin{SpanEnv}\renewcommand{\SpanEnvClose}{"
                 + end_command
                 + "}"
                 + start_command
             )
 
-        regex_replacements = {
-            rf"{after_wchar}(?:(?:\.\.\.)|(?:…)){before_wchar}": r"{\\EllipsisSplittable}",
-            r"(?:(?:\.\.\.)|(?:…))": r"{\\Ellipsis}",
-            rf"</span>": r"\\end{SpanEnv}",
-            rf'<span class="v-centered-page">': span_replacement(
-                r"\\newpage\\hspace{0pt}\\vfill ", r" \\vfill\\hspace{0pt}\\newpage"
+        # The first pattern that matches at a position wins
+        pattern_replacements = [
+            (
+                rf"{after_wchar}(?:(?:\.\.\.)|(?:…)){before_wchar}",
+                R"{\EllipsisSplittable}",
             ),
-            rf'<span class="page-break"[ ]?/>': r"\\newpage",
-            r"<i>": r"\\textit{",
-            r"</i>": r"}",
-            r"<em>": r"\\textit{",
-            r"</em>": r"}",
-            r"<u>": r"\\ul{",
-            r"</u>": r"}",
-            r"<code>": r"\\texttt{",
-            r"</code>": r"}",
-            r"<b>": r"\\textbf{",
-            r"</b>": r"}",
-            r"<strong>": r"\\textbf{",
-            r"</strong>": r"}",
-            r"<br(?:[ ]?/)?>": r"\\",
-        }
-
-        conversion_rules = [
-            UnicodeToLatexConversionRule(
-                RULE_REGEX,
-                [(regex.compile(k), v) for k, v in regex_replacements.items()],
-                replacement_latex_protection="none",
+            (r"(?:(?:\.\.\.)|(?:…))", R"{\Ellipsis}"),
+            (r"</span>", R"\end{SpanEnv}"),
+            (
+                r'<span class="v-centered-page">',
+                span_replacement(
+                    R"\newpage\hspace{0pt}\vfill ", R" \vfill\hspace{0pt}\newpage"
+                ),
             ),
-            "defaults",
+            (r'<span class="page-break"[ ]?/>', R"\newpage"),
+            (r"<i>", R"\textit{"),
+            (r"</i>", R"}"),
+            (r"<em>", R"\textit{"),
+            (r"</em>", R"}"),
+            (r"<u>", R"\ul{"),
+            (r"</u>", R"}"),
+            (r"<code>", R"\texttt{"),
+            (r"</code>", R"}"),
+            (r"<b>", R"\textbf{"),
+            (r"</b>", R"}"),
+            (r"<strong>", R"\textbf{"),
+            (r"</strong>", R"}"),
+            (r"<br(?:[ ]?/)?>", "\\"),
         ]
-        get_latex_converter.converter = UnicodeToLatexEncoder(
-            conversion_rules=conversion_rules, replacement_latex_protection="braces-all"
+
+        # Any other special or non-ASCII character, e.g. `&` or `é`, is
+        # replaced as by pylatexenc's default rules, in braces
+        char_replacements = {
+            chr(c): "{" + latex + "}"
+            for c, latex in get_builtin_uni2latex_dict().items()
+        }
+
+        def warn_unknown_char(c: str):
+            logger.warning(
+                f"No known LaTeX representation for character U+{ord(c):04X} ‘{c}’"
+            )
+
+        get_latex_converter.converter = LatexConverter(
+            pattern_replacements, char_replacements, warn_unknown_char
         )
 
     return get_latex_converter.converter
 
 
+@functools.lru_cache(maxsize=None)
+def scripts_sha256() -> str:
+    # Part of the inputs of every stage in the build journal, so that changing
+    # the scripts reruns everything
+    h = hashlib.sha256()
+    for path in sorted(Path(__file__).resolve().parent.rglob("*.py")):
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
 def format_isbn(isbn) -> str:
     isbn = f"{isbn:013}"
     return f"{isbn[:3]}-{isbn[3:4]}-{isbn[4:8]}-{isbn[8:12]}-{isbn[12]}"
 
 
+# Cached, since building several variants converts the same texts
+@functools.lru_cache(maxsize=None)
 def format_text(text: str) -> str:
-    converted_text = get_latex_converter().unicode_to_latex(text)
+    return format_paragraphs(get_latex_converter().convert(text))
+
 
+def format_paragraphs(converted_text: str) -> str:
     def transform_paragraph(p: str) -> str:
         p = p.strip()
         if p == "* * *":
@@ -205,24 +520,38 @@ def format_text(text: str) -> str:
     return text
 
 
-def convert_part_text(part: Part, work_dir: Path, content_lines: list[str]):
-    output_filename = work_dir / (part.base_filename() + ".tex")
-    input_text = part.text_filepath().read_text()
+def part_output_path(part: Part, work_dir: Path) -> Path:
+    return work_dir / (part.base_filename() + ".tex")
+
 
-    output_text = format_text(input_text)
+def convert_part_text(
+    part: Part, work_dir: Path, content_lines: list[str], convert_text=True
+):
+    output_filename = part_output_path(part, work_dir)
+    if convert_text:
+        input_text = part.text_filepath().read_text()
+
+        output_text = format_text(input_text)
 
-    output_filename.write_text(output_text)
+        output_filename.write_text(output_text)
 
     content_lines.append(Rf"\insertPartText{in_curlies(output_filename.name)}")
 
 
-def convert_part(part: Part, work_dir: Path, content_lines: list[str]):
+def convert_part(
+    part: Part, work_dir: Path, content_lines: list[str], convert_text=True
+):
     content_lines.append(Rf"\beginPart{in_curlies(f'{part.number}. {part.title}')}")
-    convert_part_text(part, work_dir, content_lines)
+    convert_part_text(part, work_dir, content_lines, convert_text)
 
 
 def convert_chapter(
-    chapter: Chapter, work_dir: Path, content_lines: list[str], img_info: ImageInfo
+    chapter: Chapter,
+    work_dir: Path,
+    content_lines: list[str],
+    img_info: ImageInfo,
+    image_suffix=".png",
+    convert_text=True,
 ):
     part1 = chapter.parts[0]
     part_title_string = ""
@@ -230,20 +559,20 @@ def convert_chapter(
         part_title_string = f"[{part1.number}. {part1.title}]"
 
     content_lines.append(
-        Rf"\beginChapter{part_title_string}{in_curlies(chapter.title)}{in_curlies(chapter.subtitle)}{in_curlies(image_latex_path(img_info))}"
+        Rf"\beginChapter{part_title_string}{in_curlies(chapter.title)}{in_curlies(chapter.subtitle)}{in_curlies(image_latex_path(img_info, image_suffix))}"
     )
-    convert_part_text(part1, work_dir, content_lines)
+    convert_part_text(part1, work_dir, content_lines, convert_text)
 
     for part in itertools.islice(chapter.parts, 1, None):
-        convert_part(part, work_dir, content_lines)
+        convert_part(part, work_dir, content_lines, convert_text)
 
 
-def image_latex_path(img_info: ImageInfo) -> str:
-    return img_info.relative_image_path().with_suffix(".png").as_posix()
+def image_latex_path(img_info: ImageInfo, image_suffix=".png") -> str:
+    return img_info.relative_image_path().with_suffix(image_suffix).as_posix()
 
 
-def image_latex_command(img_info: ImageInfo) -> str:
-    image_path_string = image_latex_path(img_info)
+def image_latex_command(img_info: ImageInfo, image_suffix=".png") -> str:
+    image_path_string = image_latex_path(img_info, image_suffix)
     if isinstance(img_info, DoubleImage):  # Double image and subclasses
         return Rf"\insertDoubleImage{in_curlies(image_path_string)}"
     elif isinstance(img_info, SingleImage):  # Single image and subclasses
@@ -266,20 +595,59 @@ def convert_book(
     no_front_cover=False,
     no_back_cover=False,
     gutter_size=0.0,
+    image_cache: ImageCache | None = None,
+    jobs=1,
+    image_settings: "ImageSettings | None" = None,
+    output_suffix="",
+    vector_toc=False,
+    epub_outputs: "dict[Path, list[tuple[Path, bool]]] | None" = None,
+    speculative=False,
+    xelatex_format=False,
+    incremental=False,
+    image_executor: concurrent.futures.Executor | None = None,
+    hermetic_fonts=False,
+    only_chapters: "list[int] | None" = None,
+    fresh=False,
 ):
-    content_lines = []
+    if image_settings is None:
+        image_settings = ImageSettings()
+    image_suffix = image_settings.suffix
+    timings = {}
+    journal = BuildJournal(work_dir / "journal.json", fresh)
+
+    content_lines = [R"\beginSegment{front}"]
 
     global_image_config = GlobalImagesConfig.from_file(
         common_dir() / "TeX" / "Images" / "config.yaml"
     )
 
+    image_filter = None
+    if only_chapters is not None:
+        # A preview only needs the images of its chapters
+        chapter_numbers = [chapter.number for chapter in book_config.chapters]
+        unknown_chapters = [n for n in only_chapters if n not in chapter_numbers]
+        if unknown_chapters:
+            logger.critical(
+                f"Volume {book_config.volume} has no chapter(s) "
+                + ", ".join(str(n) for n in unknown_chapters)
+            )
+            sys.exit(1)
+        preview_images = [image_config.chapter_images[n] for n in only_chapters]
+        image_filter = lambda info: any(info is i for i in preview_images)
+
+    if not skip_image_generation:
+        validate_images(
+            [image_config, global_image_config], bleed_size, jobs, image_filter
+        )
+
     if image_config.front_cover is not None and not no_front_cover:
         content_lines.extend(
-            [image_latex_command(image_config.front_cover), R"\emptypage"]
+            [image_latex_command(image_config.front_cover, image_suffix), R"\emptypage"]
         )
 
     content_lines.extend(
-        image_latex_command(img_info) for img_info in image_config.insert_images
+        image_latex_command(img_info, image_suffix)
+        for img_info in image_config.insert_images
     )
 
     if image_config.titlepage is not None:
@@ -287,33 +655,64 @@ def convert_book(
             [
                 # Add a filler after the insert if the last image was on an odd page
                 R"\ifodd\value{realpage}",
-                image_latex_command(global_image_config.insert_filler),
+                image_latex_command(global_image_config.insert_filler, image_suffix),
                 R"\fi",
-                image_latex_command(image_config.titlepage),
+                image_latex_command(image_config.titlepage, image_suffix),
             ]
         )
 
     credits_background_path = (
-        global_image_config.credits_background.relative_image_path().with_suffix(".png")
+        global_image_config.credits_background.relative_image_path().with_suffix(
+            image_suffix
+        )
     )
     content_lines.extend(
         [
             Rf"\creditsPage{in_curlies(credits_background_path)}{in_curlies(book_config.publication_year)}{in_curlies(format_isbn(book_config.isbn))}{in_curlies(version_tag)}",
-            image_latex_command(global_image_config.after_credits),
+            image_latex_command(global_image_config.after_credits, image_suffix),
         ]
     )
 
-    content_lines.append(
-        Rf"\insertTableOfContents{in_curlies(image_latex_path(image_config.toc))}"
-    )
+    if vector_toc:
+        content_lines.append(
+            toc_vector_latex_command(
+                image_config.toc, bleed_size, len(book_config.chapters), image_suffix
+            )
+        )
+    else:
+        content_lines.append(
+            Rf"\insertTableOfContents{in_curlies(image_latex_path(image_config.toc, image_suffix))}"
+        )
+
+    parts = [part for chapter in book_config.chapters for part in chapter.parts]
+    part_files = [part_output_path(part, work_dir) for part in parts]
+    text_inputs = {
+        "scripts": scripts_sha256(),
+        "texts": [file_sha256(part.text_filepath()) for part in parts],
+    }
+    convert_text = not journal.is_done("text conversion", text_inputs)
+    if convert_text:
+        journal.start("text conversion")
+    else:
+        logger.info("==Skipping text conversion, unchanged since the last build==")
 
     for chapter in book_config.chapters:
         img_info = image_config.chapter_images[chapter.number]
-        convert_chapter(chapter, work_dir, content_lines, img_info)
+        content_lines.append(Rf"\beginSegment{{chapter{chapter.number}}}")
+        convert_chapter(
+            chapter, work_dir, content_lines, img_info, image_suffix, convert_text
+        )
+
+    if convert_text:
+        journal.record("text conversion", text_inputs, part_files)
 
     if image_config.back_cover is not None and not no_back_cover:
         content_lines.extend(
-            [R"\newleftpage", image_latex_command(image_config.back_cover)]
+            [
+                R"\beginSegment{back}",
+                R"\newleftpage",
+                image_latex_command(image_config.back_cover, image_suffix),
+            ]
         )
 
     content_text = "\n\n".join(content_lines)
@@ -333,7 +732,7 @@ def convert_book(
 
     intermediate_output_directory = work_dir / "CompilationDir"
     os.makedirs(intermediate_output_directory, exist_ok=True)
-    output_stem = f"WorldEnd2_v{book_config.volume:02}"
+    output_stem = f"WorldEnd2_v{book_config.volume:02}{output_suffix}"
     main_tex_file = common_dir() / "TeX" / "WorldEnd2_Common.tex"
     tex_inputs = env_path_prepend(os.environ.get("TEXINPUTS"), work_dir, ".")
     tex_inputs_no_images = env_path_prepend(
@@ -344,63 +743,676 @@ def convert_book(
         intermediate_output_directory / f"{output_stem}.page-numbers.txt"
     )
 
-    args = [
-        arg.format(
-            MODE="nonstopmode" if logger.isEnabledFor(logging.DEBUG) else "batchmode",
-            OUTPUT_DIRECTORY=intermediate_output_directory,
-            JOB_NAME=output_stem,
-            TEX_FILE=main_tex_file,
+    env = os.environ.copy()
+    if hermetic_fonts:
+        start_time = time.perf_counter()
+        env["FONTCONFIG_FILE"] = str(prepare_font_config())
+        timings["fonts"] = time.perf_counter() - start_time
+
+    format_path = None
+    if xelatex_format:
+        start_time = time.perf_counter()
+        format_path = prepare_xelatex_format(
+            xelatex_command_line, main_tex_file, cache_dir() / "formats", env
         )
-        for arg in shlex.split(xelatex_command_line)
-    ]
+        timings["format"] = time.perf_counter() - start_time
 
-    logger.debug(" ".join(args))
+    image_configs = [image_config, global_image_config]
 
-    env = os.environ.copy()
+    def generate_volume_images(image_filter=None):
+        image_jobs = volume_image_jobs(
+            image_configs, work_dir, bleed_size, image_settings, image_filter
+        )
+        epub_files = {
+            str(source): [str(path) for path, _ in outputs]
+            for source, outputs in (epub_outputs or {}).items()
+        }
+        # A preview's images are journaled apart from the full set
+        stage = "images" if image_filter is None else "preview images"
+        images_inputs = {
+            "scripts": scripts_sha256(),
+            "images": [(job.dedup_key(), job.output_path) for job in image_jobs],
+            "epub": epub_files,
+        }
+        if journal.is_done(stage, images_inputs):
+            logger.info("==Skipping images, unchanged since the last build==")
+            return
+        journal.start(stage)
+        generate_images(
+            image_configs,
+            work_dir,
+            bleed_size,
+            image_settings,
+            image_cache,
+            jobs,
+            epub_outputs,
+            image_executor,
+            image_filter,
+        )
+        journal.record(
+            stage,
+            images_inputs,
+            [job.output_path for job in image_jobs]
+            + [Path(p) for paths in epub_files.values() for p in paths],
+        )
+
+    args = xelatex_args(
+        xelatex_command_line,
+        format_path,
+        # The supervisor follows the terminal output, which batchmode suppresses
+        MODE="nonstopmode",
+        OUTPUT_DIRECTORY=intermediate_output_directory,
+        JOB_NAME=output_stem,
+        TEX_FILE=main_tex_file,
+    )
+
+    logger.debug(" ".join(args))
 
     # We do two passes for two reasons: 1) It resolves an issue with images not
     # being centered correctly the first time we compile, and 2) We auto-generate the
     # table of contents with correct page numbers, which requires a first pass to
     # actually determine the page numbers.
-    # The first pass doesn't take very long since we don't print the images.
-
-    if not skip_image_generation:
-        generate_images([image_config, global_image_config], work_dir, bleed_size)
-
-    logger.info("==Starting xelatex (first pass)==")
-    env["TEXINPUTS"] = tex_inputs_no_images
-    subprocess.run(args=args, env=env, cwd=str(main_tex_file.parent))
+    # The first pass doesn't take very long since we don't print the images. It
+    # doesn't read them either, so it runs while the images are being generated.
+
+    segment_manifest_path = work_dir / "Segments" / "segments.json"
+    segments = split_segments(content_lines)
+
+    if only_chapters is not None:
+        layout = read_segment_layout(segment_manifest_path, segments)
+        if layout is None:
+            logger.critical(
+                "A chapter preview starts each chapter on the page it started on "
+                + "in the last full build, so run a full build in this output "
+                + "directory first"
+            )
+            sys.exit(1)
+
+        start_time = time.perf_counter()
+        if not skip_image_generation:
+            generate_volume_images(image_filter)
+        timings["images"] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        compile_preview(
+            segments,
+            layout,
+            only_chapters,
+            output_dir / f"{output_stem}-preview.pdf",
+            work_dir,
+            main_tex_file,
+            xelatex_command_line,
+            format_path,
+            env,
+        )
+        timings["preview"] = time.perf_counter() - start_time
+        logger.info("==Finished xelatex==")
+        for stage, seconds in timings.items():
+            logger.debug(f"{stage}: {seconds:.1f}s")
+        return timings
+
+    layout = None
+    if incremental:
+        if vector_toc:
+            logger.warning("Incremental builds don't support --vector-toc")
+        else:
+            layout = read_segment_layout(segment_manifest_path, segments)
+        previous_page_numbers = read_previous_page_numbers(
+            page_numbers_file, len(book_config.chapters)
+        )
+        if layout is None or previous_page_numbers is None:
+            logger.info(
+                "No layout from a previous full build, not building incrementally"
+            )
+            layout = None
+
+    if layout is not None:
+        start_time = time.perf_counter()
+        if not skip_image_generation:
+            generate_volume_images()
+            # A fallback to a full build reuses these
+            skip_image_generation = True
+            epub_outputs = None
+        timings["images"] = time.perf_counter() - start_time
+
+        if not no_images and image_config.toc is not None:
+            write_toc_image(
+                image_config.toc,
+                work_dir,
+                bleed_size,
+                image_settings,
+                previous_page_numbers,
+            )
 
-    if not no_images:
+        start_time = time.perf_counter()
+        image_keys = {
+            image_latex_path(img_info, image_suffix): ImageJob(
+                img_info, work_dir, bleed_size, image_settings
+            ).dedup_key()
+            for config in [image_config, global_image_config]
+            for img_info in config.all_images_iter()
+        }
         if image_config.toc is not None:
-            image_info = image_config.toc
-            original_toc_path = image_info.absolute_image_path()
-            toc_with_page_numbers_path = (
-                work_dir / image_info.relative_image_path()
-            ).with_name("temp-toc.png")
-            output_path = (work_dir / image_info.relative_image_path()).with_suffix(
-                ".png"
-            )
+            # The page numbers are drawn onto the TOC
+            toc_path = image_latex_path(image_config.toc, image_suffix)
+            image_keys[toc_path] += tuple(previous_page_numbers)
+        final_output_file = output_dir / (output_stem + ".pdf")
+        if compile_segments(
+            segments,
+            layout,
+            segment_manifest_path,
+            final_output_file,
+            work_dir,
+            main_tex_file,
+            xelatex_command_line,
+            format_path,
+            image_keys,
+            env,
+            jobs,
+        ):
+            timings["segments"] = time.perf_counter() - start_time
+            logger.info(f"==Stitched {len(segments)} segments==")
+            for stage, seconds in timings.items():
+                logger.debug(f"{stage}: {seconds:.1f}s")
+            return timings
+        logger.info("==Page count of a segment changed, starting a full build==")
+
+    aux_file = intermediate_output_directory / (output_stem + ".aux")
+    predicted_page_numbers = None
+    if speculative:
+        # Most edits don't move the chapter starts, so the page numbers of the
+        # previous build are used for the TOC and the first pass is skipped
+        predicted_page_numbers = read_previous_page_numbers(
+            page_numbers_file, len(book_config.chapters)
+        )
+        if predicted_page_numbers is None:
+            logger.info("No page numbers from a previous build, not speculating")
+
+    log_file = intermediate_output_directory / (output_stem + ".log")
+    # The passes of the default two-pass build are journaled too. The first
+    # pass's .aux file is kept, since the second pass overwrites it even when
+    # it fails
+    journal_passes = predicted_page_numbers is None and not vector_toc
+    first_pass_aux_file = intermediate_output_directory / (
+        output_stem + ".first-pass.aux"
+    )
+    first_pass_inputs = {
+        "scripts": scripts_sha256(),
+        "args": args,
+        "preamble": main_tex_file.read_text(),
+        "content": content_text,
+        "config": config_text,
+        "texts": file_fingerprints(part_files),
+    }
+    first_pass_page_numbers = None
+    if journal_passes and journal.is_done("first pass", first_pass_inputs):
+        logger.info("==Skipping the first pass, unchanged since the last build==")
+        shutil.copyfile(first_pass_aux_file, aux_file)
+        first_pass_page_numbers = journal.result("first pass")
+
+        start_time = time.perf_counter()
+        if not skip_image_generation:
+            generate_volume_images()
+        timings["images"] = time.perf_counter() - start_time
+    elif predicted_page_numbers is None:
+        journal.start("first pass")
+        start_time = time.perf_counter()
+        env["TEXINPUTS"] = tex_inputs_no_images
+        first_pass = start_xelatex(
+            args, env, main_tex_file.parent, log_file, "first pass"
+        )
 
-            page_numbers = get_page_numbers(page_numbers_file)
-            draw_page_numbers(
-                page_numbers, original_toc_path, toc_with_page_numbers_path
+        try:
+            if not skip_image_generation:
+                generate_volume_images()
+            timings["images"] = time.perf_counter() - start_time
+        except BaseException:
+            first_pass.kill()
+            raise
+
+        finish_xelatex(first_pass, "first pass")
+        timings["images and first pass"] = time.perf_counter() - start_time
+
+        if journal_passes:
+            first_pass_page_numbers = get_page_numbers(page_numbers_file)
+            shutil.copyfile(aux_file, first_pass_aux_file)
+            journal.record(
+                "first pass",
+                first_pass_inputs,
+                [first_pass_aux_file],
+                first_pass_page_numbers,
             )
-            generate_single_image(
-                toc_with_page_numbers_path,
-                output_path,
-                image_info.padding_lrtb(bleed_size),
+    else:
+        start_time = time.perf_counter()
+        if not skip_image_generation:
+            generate_volume_images()
+        timings["images"] = time.perf_counter() - start_time
+
+    previous_aux_text = aux_file.read_bytes() if aux_file.exists() else None
+    draw_toc = not no_images and not vector_toc and image_config.toc is not None
+
+    start_time = time.perf_counter()
+    if draw_toc:
+        page_numbers = predicted_page_numbers
+        if page_numbers is None:
+            page_numbers = first_pass_page_numbers
+        if page_numbers is None:
+            page_numbers = get_page_numbers(page_numbers_file)
+        toc_job = ImageJob(image_config.toc, work_dir, bleed_size, image_settings)
+        toc_inputs = {
+            "scripts": scripts_sha256(),
+            "page_numbers": page_numbers,
+            "image": toc_job.dedup_key(),
+            "base_image": file_fingerprints([toc_base_image_path(toc_job.output_path)]),
+        }
+        if journal.is_done("table of contents", toc_inputs):
+            logger.info("==Skipping the TOC, unchanged since the last build==")
+        else:
+            journal.start("table of contents")
+            write_toc_image(
+                image_config.toc, work_dir, bleed_size, image_settings, page_numbers
             )
+            journal.record("table of contents", toc_inputs, [toc_job.output_path])
+    timings["table of contents"] = time.perf_counter() - start_time
 
-    logger.info("==Starting xelatex (second pass)==")
+    final_output_file = output_dir / (output_stem + ".pdf")
+    image_files = [
+        job.output_path
+        for job in volume_image_jobs(
+            image_configs, work_dir, bleed_size, image_settings
+        )
+    ]
+    if image_config.toc is not None:
+        toc_job = ImageJob(image_config.toc, work_dir, bleed_size, image_settings)
+        image_files.append(toc_job.output_path)
+    second_pass_inputs = {
+        **first_pass_inputs,
+        "files": file_fingerprints(part_files + image_files + [first_pass_aux_file]),
+    }
+    if journal_passes and journal.is_done("second pass", second_pass_inputs):
+        logger.info(f"==Skipping the second pass, {final_output_file} is up to date==")
+        for stage, seconds in timings.items():
+            logger.debug(f"{stage}: {seconds:.1f}s")
+        return timings
+
+    main_pass = "second pass" if predicted_page_numbers is None else "speculative pass"
+    journal.start("second pass")
+    start_time = time.perf_counter()
     env["TEXINPUTS"] = tex_inputs
-    subprocess.run(args=args, env=env, cwd=str(main_tex_file.parent))
+    run_xelatex(args, env, main_tex_file.parent, log_file, main_pass)
+    timings[main_pass] = time.perf_counter() - start_time
+
+    if predicted_page_numbers is not None and not vector_toc:
+        # The speculation held if the chapters start on the predicted pages and
+        # nothing else in the .aux file changed either
+        actual_page_numbers = get_page_numbers(page_numbers_file)
+        aux_text = aux_file.read_bytes() if aux_file.exists() else None
+        if (
+            actual_page_numbers != predicted_page_numbers
+            or aux_text != previous_aux_text
+        ):
+            logger.info("Page numbers or references changed")
+            start_time = time.perf_counter()
+            if draw_toc and actual_page_numbers != predicted_page_numbers:
+                write_toc_image(
+                    image_config.toc,
+                    work_dir,
+                    bleed_size,
+                    image_settings,
+                    actual_page_numbers,
+                )
+            run_xelatex(args, env, main_tex_file.parent, log_file, "corrective pass")
+            timings["corrective pass"] = time.perf_counter() - start_time
+
+    if vector_toc:
+        # The TOC page numbers are page references, so rerun until they (and
+        # everything else in the .aux file) no longer change
+        for xelatex_pass in itertools.count(3):
+            aux_text = aux_file.read_bytes() if aux_file.exists() else None
+            if aux_text == previous_aux_text:
+                break
+            if xelatex_pass > MAX_XELATEX_PASSES:
+                logger.warning(
+                    f"References still changed after {MAX_XELATEX_PASSES} xelatex passes"
+                )
+                break
+            previous_aux_text = aux_text
+
+            start_time = time.perf_counter()
+            run_xelatex(
+                args, env, main_tex_file.parent, log_file, f"pass {xelatex_pass}"
+            )
+            timings[f"pass {xelatex_pass}"] = time.perf_counter() - start_time
 
     logger.info("==Finished xelatex==")
     intermediate_output_file = intermediate_output_directory / (output_stem + ".pdf")
-    final_output_file = output_dir / (output_stem + ".pdf")
     if intermediate_output_file.exists():
+        write_segment_layout(
+            segment_manifest_path,
+            intermediate_output_directory / f"{output_stem}.segments.txt",
+            intermediate_output_file,
+        )
         shutil.move(intermediate_output_file, final_output_file)
+        if journal_passes:
+            journal.record("second pass", second_pass_inputs, [final_output_file])
+    else:
+        logger.error("No PDF file generated")
+
+    for stage, seconds in timings.items():
+        logger.debug(f"{stage}: {seconds:.1f}s")
+    return timings
+
+
+def start_xelatex(
+    args: list[str],
+    env: dict[str, str],
+    cwd: Path,
+    log_file: Path,
+    pass_name: str,
+    progress=True,
+) -> XelatexProcess:
+    variant = current_variant.get()
+    if variant is not None and variant.cancelled:
+        sys.exit(1)
+    logger.info(f"==Starting xelatex ({pass_name})==")
+
+    def log_progress(pages: int, seconds: float):
+        logger.info(
+            f"xelatex ({pass_name}): {pages} pages, {pages / seconds:.1f} pages/s"
+        )
+
+    process = XelatexProcess(
+        args,
+        env,
+        cwd,
+        log_file,
+        echo=logger.isEnabledFor(logging.DEBUG),
+        on_progress=log_progress if progress else None,
+        progress_interval=XELATEX_PROGRESS_INTERVAL,
+    )
+    process.start()
+    if variant is not None:
+        variant.add_process(process)
+    return process
+
+
+def finish_xelatex(process: XelatexProcess, pass_name: str) -> XelatexResult:
+    # Waits for the pass, and stops the build if it failed, since every later
+    # pass would fail the same way
+    result = process.wait()
+    variant = current_variant.get()
+    if variant is not None:
+        variant.remove_process(process)
+        if variant.cancelled:
+            # Killed because another variant failed, which is reported instead
+            sys.exit(1)
+    logger.info(
+        f"==Finished xelatex ({pass_name}): {result.pages} pages in "
+        + f"{result.seconds:.1f}s ({result.pages_per_second():.1f} pages/s)=="
+    )
+    if result.fatal:
+        message = f"xelatex ({pass_name}) failed with exit code {result.returncode}"
+        if result.errors:
+            message += f", see {process.log_file}:\n{result.errors[0]}"
+        logger.critical(message)
+        sys.exit(1)
+    if result.errors:
+        logger.warning(
+            f"xelatex ({pass_name}) reported {len(result.errors)} error(s), "
+            + f"the first one:\n{result.errors[0]}"
+        )
+    return result
+
+
+def run_xelatex(
+    args: list[str],
+    env: dict[str, str],
+    cwd: Path,
+    log_file: Path,
+    pass_name: str,
+    progress=True,
+) -> XelatexResult:
+    process = start_xelatex(args, env, cwd, log_file, pass_name, progress)
+    return finish_xelatex(process, pass_name)
+
+
+def run_xelatex_until_stable(
+    args: list[str],
+    env: dict[str, str],
+    cwd: Path,
+    output_directory: Path,
+    job_name: str,
+    pass_name: str,
+    progress=True,
+):
+    # Like the full build, rerun until the .aux file is stable
+    aux_file = output_directory / f"{job_name}.aux"
+    previous_aux_text = aux_file.read_bytes() if aux_file.exists() else None
+    for _ in range(MAX_XELATEX_PASSES):
+        run_xelatex(
+            args, env, cwd, output_directory / f"{job_name}.log", pass_name, progress
+        )
+        aux_text = aux_file.read_bytes() if aux_file.exists() else None
+        if aux_text == previous_aux_text:
+            break
+        previous_aux_text = aux_text
+
+
+def split_segments(content_lines: list[str]) -> "list[tuple[str, list[str]]]":
+    # Splits the content at each `\beginSegment`, without the command itself
+    segments = []
+    for line in content_lines:
+        match = regex.fullmatch(r"\\beginSegment\{([^}]*)\}", line)
+        if match:
+            segments.append((match.group(1), []))
+        else:
+            segments[-1][1].append(line)
+    return segments
+
+
+def read_segment_manifest(manifest_path: Path) -> dict:
+    try:
+        return json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def write_segment_layout(manifest_path: Path, segments_file: Path, pdf_file: Path):
+    # Records the first page of each segment in a full build, and how many
+    # pages it has, so that later builds can compile the segments separately
+    try:
+        lines = segments_file.read_text().splitlines()
+    except OSError:
+        return
+    layout = []
+    for line in lines:
+        name, page, realpage = line.split()
+        layout.append({"name": name, "page": int(page), "realpage": int(realpage)})
+    total_pages = page_count(pdf_file)
+    for entry, next_realpage in zip(
+        layout, [e["realpage"] for e in layout[1:]] + [total_pages + 1]
+    ):
+        entry["pages"] = next_realpage - entry["realpage"]
+
+    manifest = read_segment_manifest(manifest_path)
+    manifest["layout"] = layout
+    os.makedirs(manifest_path.parent, exist_ok=True)
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+
+
+def read_segment_layout(
+    manifest_path: Path, segments: "list[tuple[str, list[str]]]"
+) -> "list[dict] | None":
+    # Returns None if the segments changed since the last full build, e.g.
+    # when a chapter was added
+    layout = read_segment_manifest(manifest_path).get("layout")
+    if layout is None or [e["name"] for e in layout] != [n for n, _ in segments]:
+        return None
+    return layout
+
+
+def segment_content_lines(index: int, entry: dict, lines: list[str]) -> list[str]:
+    # Every segment but the first continues where the previous one ended
+    if index == 0:
+        return lines
+    return [
+        R"\pagenumbering{arabic}",
+        Rf"\setcounter{{page}}{{{entry['page']}}}",
+        Rf"\setcounter{{realpage}}{{{entry['realpage']}}}",
+        # Every segment after the first one starts a chapter, or is the back
+        Rf"\setcounter{{ChapterNum}}{{{index - 1}}}",
+        *lines,
+    ]
+
+
+def compile_segments(
+    segments: "list[tuple[str, list[str]]]",
+    layout: "list[dict]",
+    manifest_path: Path,
+    output_file: Path,
+    work_dir: Path,
+    main_tex_file: Path,
+    xelatex_command_line: str,
+    format_path: Path | None,
+    image_keys: dict[str, tuple],
+    base_env: dict[str, str],
+    jobs=1,
+) -> bool:
+    # Compiles each segment on its own, starting on the same page as in the
+    # last full build, and stitches them together. Unchanged segments are
+    # reused. Returns False if a segment's page count changed, in which case
+    # the following segments would have moved and a full build is needed
+    segment_dir = manifest_path.parent
+    manifest = read_segment_manifest(manifest_path)
+    segment_keys = manifest.get("segments", {})
+    config_text = (work_dir / "config.tex").read_text()
+    preamble_text = main_tex_file.read_text()
+
+    changed = []
+    for index, ((name, lines), entry) in enumerate(zip(segments, layout)):
+        content_text = "\n\n".join(segment_content_lines(index, entry, lines))
+        part_files = regex.findall(r"\\insertPartText\{([^}]*)\}", content_text)
+        key_data = {
+            "content": content_text,
+            "config": config_text,
+            "preamble": preamble_text,
+            "parts": {f: (work_dir / f).read_text() for f in part_files},
+            "images": {p: k for p, k in image_keys.items() if p in content_text},
+            "command_line": xelatex_command_line,
+        }
+        key_json = json.dumps(key_data, sort_keys=True, default=str)
+        key = hashlib.sha256(key_json.encode("utf-8")).hexdigest()
+
+        pdf_file = segment_dir / name / f"{name}.pdf"
+        if segment_keys.get(name) == key and pdf_file.exists():
+            continue
+        os.makedirs(segment_dir / name, exist_ok=True)
+        (segment_dir / name / "content.tex").write_text(content_text)
+        segment_keys.pop(name, None)
+        changed.append((name, key))
+
+    logger.info(f"==Compiling {len(changed)} of {len(segments)} segments==")
+
+    def compile_segment(name: str):
+        output_directory = segment_dir / name
+        env = dict(base_env)
+        env["TEXINPUTS"] = env_path_prepend(
+            os.environ.get("TEXINPUTS"), output_directory, work_dir, "."
+        )
+        args = xelatex_args(
+            xelatex_command_line,
+            format_path,
+            MODE="nonstopmode",
+            OUTPUT_DIRECTORY=output_directory,
+            JOB_NAME=name,
+            TEX_FILE=main_tex_file,
+        )
+        run_xelatex_until_stable(
+            args,
+            env,
+            main_tex_file.parent,
+            output_directory,
+            name,
+            f"segment {name}",
+            # The segments are compiled in parallel, so only their summaries
+            # are logged
+            progress=False,
+        )
+        logger.debug(f"Compiled segment {name}")
+
+    # xelatex is single-threaded, so the segments are compiled in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [
+            # In the context of the variant, if any
+            executor.submit(contextvars.copy_context().run, compile_segment, name)
+            for name, _ in changed
+        ]
+        for future in futures:
+            future.result()
+
+    pdf_files = [segment_dir / name / f"{name}.pdf" for name, _ in segments]
+    for name, key in changed:
+        if (segment_dir / name / f"{name}.pdf").exists():
+            segment_keys[name] = key
+    manifest["segments"] = segment_keys
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+
+    for pdf_file, entry in zip(pdf_files, layout):
+        if not pdf_file.exists():
+            logger.error(f"No PDF file generated for segment {entry['name']}")
+            return False
+        if page_count(pdf_file) != entry["pages"]:
+            logger.debug(f"Page count of segment {entry['name']} changed")
+            return False
+
+    stitch_pdfs(pdf_files, output_file)
+    return True
+
+
+def compile_preview(
+    segments: "list[tuple[str, list[str]]]",
+    layout: "list[dict]",
+    chapter_numbers: list[int],
+    output_file: Path,
+    work_dir: Path,
+    main_tex_file: Path,
+    xelatex_command_line: str,
+    format_path: Path | None,
+    base_env: dict[str, str],
+):
+    # Compiles only the given chapters, each starting on the page it started
+    # on in the last full build, so that the folios, headers and left and
+    # right pages are the same as in the full PDF
+    preview_dir = work_dir / "Preview"
+    os.makedirs(preview_dir, exist_ok=True)
+    chapter_names = {f"chapter{n}" for n in chapter_numbers}
+    content_lines = []
+    for index, ((name, lines), entry) in enumerate(zip(segments, layout)):
+        if name in chapter_names:
+            # The counters only apply to the next page
+            content_lines.append(R"\newpage")
+            content_lines.extend(segment_content_lines(index, entry, lines))
+    (preview_dir / "content.tex").write_text("\n\n".join(content_lines))
+
+    env = dict(base_env)
+    env["TEXINPUTS"] = env_path_prepend(
+        os.environ.get("TEXINPUTS"), preview_dir, work_dir, "."
+    )
+    args = xelatex_args(
+        xelatex_command_line,
+        format_path,
+        MODE="nonstopmode",
+        OUTPUT_DIRECTORY=preview_dir,
+        JOB_NAME="preview",
+        TEX_FILE=main_tex_file,
+    )
+    run_xelatex_until_stable(
+        args, env, main_tex_file.parent, preview_dir, "preview", "preview"
+    )
+
+    preview_pdf_file = preview_dir / "preview.pdf"
+    if preview_pdf_file.exists():
+        shutil.move(preview_pdf_file, output_file)
     else:
         logger.error("No PDF file generated")
 
@@ -418,23 +1430,76 @@ def get_page_numbers(file_path: Path):
     return page_numbers
 
 
-def draw_page_numbers(page_numbers: list[int], toc_path: Path, output_path: Path):
-    padded_numbers = [str(num - 3).zfill(3) for num in page_numbers]
+def read_previous_page_numbers(file_path: Path, chapter_count: int):
+    # Returns None if there is no usable prediction, e.g. on the first build or
+    # after chapters were added
+    try:
+        page_numbers = get_page_numbers(file_path)
+    except (OSError, ValueError):
+        return None
+    if len(page_numbers) != chapter_count:
+        return None
+    return page_numbers
 
-    image = Image.open(toc_path)
+
+def write_toc_image(
+    toc_info: ImageInfo,
+    work_dir: Path,
+    bleed_size: float,
+    settings: "ImageSettings",
+    page_numbers: list[int],
+):
+    # The padded and inpainted TOC was generated along with the other images,
+    # so only the page numbers need to be drawn onto it
+    toc_job = ImageJob(toc_info, work_dir, bleed_size, settings)
+    toc_base_path = toc_base_image_path(toc_job.output_path)
+    toc_image = cv2.imread(str(toc_base_path))
+    if toc_image is None:
+        logger.critical(f"Could not read the TOC image {toc_base_path}")
+        sys.exit(1)
+
+    l, r, t, b = toc_job.padding_lrtb
+    toc_image = cv2_to_pil(toc_image)
+    draw_page_numbers(page_numbers, toc_image, (l, t), toc_job.scale)
+    write_image(toc_job.output_path, pil_to_cv2(toc_image), toc_job.encoding)
+
+
+def draw_page_numbers(
+    page_numbers: list[int],
+    image: Image.Image,
+    offset: "tuple[float, float]" = (0, 0),
+    scale=1.0,
+):
+    # The positions are relative to the source TOC image, so they are moved by
+    # the padding (`offset`) and scaled like the generated image
+    padded_numbers = [str(num - 3).zfill(3) for num in page_numbers]
 
     draw = ImageDraw.Draw(image)
-    font = ImageFont.truetype(
+    font = toc_page_number_font(TOC_PAGE_NUMBER_SIZE * scale)
+
+    text_color = (0, 0, 0)
+
+    positions = toc_page_number_positions(len(padded_numbers))
+    for number, (x, y) in zip(padded_numbers, positions):
+        text = "P\u2009.\u2009" + number
+        text_position = ((offset[0] + x) * scale, (offset[1] + y) * scale)
+        draw.text(text_position, text, fill=text_color, font=font)
+
+
+def toc_page_number_font(size: float) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(
         common_dir()
         / "TeX"
         / "Fonts"
         / "HomepageBaukasten-Book"
         / "HomepageBaukasten-Book-Modified.ttf",
-        size=42,
+        size=size,
     )
 
-    text_color = (0, 0, 0)
 
+def toc_page_number_positions(count: int) -> "list[tuple[float, float]]":
+    # Top left corner of each chapter's page number, in pixels of the source
+    # TOC image
     offshift_x = 1301
     offshift_y = 246
 
@@ -446,60 +1511,603 @@ def draw_page_numbers(page_numbers: list[int], toc_path: Path, output_path: Path
 
     num_rows = 4
 
-    for number in padded_numbers:
-        text = "P\u2009.\u2009" + number
-
-        text_position = (
-            first_row_x + offshift_x * position_x,
-            first_row_y + offshift_y * position_y,
+    positions = []
+    for _ in range(count):
+        positions.append(
+            (
+                first_row_x + offshift_x * position_x,
+                first_row_y + offshift_y * position_y,
+            )
         )
 
         position_y += 1
         if position_y == num_rows:
             position_y = 0
             position_x = 1
+    return positions
+
+
+def toc_vector_latex_command(
+    img_info: ImageInfo, bleed_size: float, chapter_count: int, image_suffix=".png"
+) -> str:
+    # Instead of drawing the page numbers onto the TOC image, let LaTeX typeset
+    # them over it from page references. All positions are given as fractions
+    # of the canvas height, since the image is placed with the height of the
+    # paper
+    image_path = toc_base_image_path(
+        img_info.relative_image_path().with_suffix(image_suffix)
+    )
+    l, r, t, b = img_info.padding_lrtb(bleed_size)
+    canvas_w, canvas_h = img_info.canvas_size_px(bleed_size)
+    ascent, _ = toc_page_number_font(TOC_PAGE_NUMBER_SIZE).getmetrics()
+
+    left_page_numbers = []
+    right_page_numbers = []
+    positions = toc_page_number_positions(chapter_count)
+    for chapter_number, (x, y) in enumerate(positions, start=1):
+        # PIL places the text by its top left corner, LaTeX by its baseline
+        x, baseline_y = x + l, y + t + ascent
+        page_numbers = left_page_numbers if x < canvas_w / 2 else right_page_numbers
+        page_numbers.append(
+            Rf"\tocPageNumber{{{x / canvas_h:.6f}}}{{{baseline_y / canvas_h:.6f}}}{{{chapter_number}}}"
+        )
 
-        draw.text(text_position, text, fill=text_color, font=font)
-
-    image.save(output_path)
+    return (
+        Rf"\insertTableOfContentsWithNumbers{in_curlies(image_path.as_posix())}"
+        + in_curlies(f"{canvas_w / canvas_h:.6f}")
+        + in_curlies(f"{TOC_PAGE_NUMBER_SIZE / canvas_h:.6f}")
+        + in_curlies("".join(left_page_numbers))
+        + in_curlies("".join(right_page_numbers))
+    )
 
-    image.close()
 
+def toc_base_image_path(output_path: Path) -> Path:
+    return output_path.with_stem(output_path.stem + "-base")
+
+
+class ImageSettings(DebugPrintable):
+    bleed_fill: str
+    inpaint_mode: str
+    memory_budget: int | None
+    encoding: str
+    target_dpi: float | None
+    resample: str
+    proxy_scale: float | None
+
+    def __init__(
+        self,
+        bleed_fill="telea",
+        inpaint_mode="band",
+        memory_budget: int | None = None,
+        encoding="png",
+        target_dpi: float | None = None,
+        resample="area",
+        proxy_scale: float | None = None,
+    ):
+        self.bleed_fill = bleed_fill
+        self.inpaint_mode = inpaint_mode
+        self.memory_budget = memory_budget
+        self.encoding = encoding
+        self.target_dpi = target_dpi
+        self.resample = resample
+        self.proxy_scale = proxy_scale
+
+    @property
+    def suffix(self) -> str:
+        return IMAGE_ENCODINGS[self.encoding][0]
+
+
+class ImageJob(DebugPrintable):
+    name: str
+    input_path: Path
+    source_sha256: str
+    output_path: Path
+    padding_lrtb: tuple[int, int, int, int]
+    bleed_fill: str
+    inpaint_mode: str
+    max_window_pixels: int | None
+    encoding: str
+    scale: float
+    resample: str
+    scale_before_fill: bool
+    epub_outputs: "list[tuple[Path, bool]]"
+
+    def __init__(
+        self,
+        image_info: ImageInfo,
+        work_dir: Path,
+        bleed_size: float,
+        settings: ImageSettings,
+    ):
+        self.name = image_info.relative_image_path().as_posix()
+        self.input_path = image_info.absolute_image_path()
+        self.source_sha256 = image_info.sha256
+        self.output_path = (work_dir / image_info.relative_image_path()).with_suffix(
+            settings.suffix
+        )
+        self.encoding = settings.encoding
+        self.padding_lrtb = image_info.padding_lrtb(bleed_size)
+        # The image's own config takes precedence over the command line
+        self.bleed_fill = image_info.bleed_fill or settings.bleed_fill
+        if self.bleed_fill not in BLEED_FILL_STRATEGIES:
+            raise ValueError(f"Unknown bleed fill `{self.bleed_fill}` for {self.name}")
+        self.inpaint_mode = settings.inpaint_mode
+        self.max_window_pixels = None
+        self.epub_outputs = []
+
+        # Images are only ever downsampled, never upscaled
+        self.scale = 1.0
+        self.scale_before_fill = False
+        if settings.proxy_scale is not None:
+            # Proxies only need to look right, so fill the small canvas
+            self.scale = min(1.0, settings.proxy_scale)
+            self.scale_before_fill = True
+        elif settings.target_dpi is not None:
+            self.scale = min(1.0, settings.target_dpi / image_info.px_per_in)
+        self.resample = settings.resample
+
+        # If holding the decoded image, the padded canvas and the inpainted
+        # result in memory at once would exceed the budget, pad onto a
+        # memory-mapped canvas instead and inpaint it in bounded windows
+        if (
+            settings.memory_budget is not None
+            and not self.scale_before_fill
+            and self.bleed_fill in INPAINT_METHODS
+            and self.inpaint_mode == "band"
+        ):
+            img_w, img_h = image_info.size_px
+            canvas_w, canvas_h = image_info.canvas_size_px(bleed_size)
+            image_bytes = img_w * img_h * 3
+            if image_bytes + 2 * (canvas_w * canvas_h * 3) > settings.memory_budget:
+                self.max_window_pixels = max(
+                    MIN_INPAINT_WINDOW_PIXELS,
+                    (settings.memory_budget - image_bytes) // INPAINT_BYTES_PER_PIXEL,
+                )
+
+    def cache_params(self) -> dict:
+        return {
+            "pipeline_version": IMAGE_PIPELINE_VERSION,
+            "padding_lrtb": self.padding_lrtb,
+            "bleed_fill": self.bleed_fill,
+            "inpaint_radius": INPAINT_RADIUS,
+            "inpaint_mode": self.inpaint_mode,
+            "max_window_pixels": self.max_window_pixels,
+            "encoding": self.encoding,
+            "scale": self.scale,
+            "resample": self.resample,
+            "scale_before_fill": self.scale_before_fill,
+        }
 
-def generate_images(configs: "list[ImageInfo]", work_dir: Path, bleed_size: float):
-    for image_info in itertools.chain.from_iterable(
-        c.all_images_iter() for c in configs
+    def dedup_key(self) -> tuple:
+        # Jobs with the same key produce byte-identical outputs
+        return (self.source_sha256, *sorted(self.cache_params().items()))
+
+
+def run_image_job(job: ImageJob, image_cache: ImageCache | None) -> str:
+    # Returns how the image was produced: "linked" (from the unchanged
+    # source), "cached" or "generated"
+    img = None
+    if job.epub_outputs:
+        with Image.open(job.input_path) as src:
+            shared_decode = src.mode in ("RGB", "RGBA")
+        if shared_decode:
+            # The decoded image is shared with the EPUB images
+            img = cv2.imread(str(job.input_path))
+            pil_img = cv2_to_pil(img)
+        else:
+            # Other modes would not convert to the same EPUB image
+            pil_img = Image.open(job.input_path)
+        for epub_output_path, scale_height in job.epub_outputs:
+            logger.debug(f"Writing EPUB image {epub_output_path.name} for {job.name}")
+            os.makedirs(epub_output_path.parent, exist_ok=True)
+            save_epub_image(pil_img, epub_output_path, scale_height)
+        del pil_img
+        if job.max_window_pixels is not None:
+            # Don't hold on to the whole image while inpainting in windows
+            img = None
+
+    if (
+        job.output_path.suffix == ".png"
+        and job.scale == 1.0
+        and is_passthrough_image(job.input_path, job.padding_lrtb)
     ):
-        input_path = image_info.absolute_image_path()
-        output_path = (work_dir / image_info.relative_image_path()).with_suffix(".png")
-        padding_lrtb = image_info.padding_lrtb(bleed_size)
+        # Linking the source is cheaper than even looking it up in the cache
+        logger.debug(f"Linking unchanged image {job.name}")
+        os.makedirs(job.output_path.parent, exist_ok=True)
+        link_or_copy(job.input_path, job.output_path)
+        return "linked"
+
+    key = None
+    if image_cache is not None:
+        key = image_cache.key(job.source_sha256, **job.cache_params())
+        if image_cache.fetch(key, job.output_path, job.output_path.suffix):
+            logger.debug(f"Using cached image for {job.name}")
+            return "cached"
+
+    generate_single_image(
+        job.input_path,
+        job.output_path,
+        job.padding_lrtb,
+        job.bleed_fill,
+        job.inpaint_mode,
+        job.max_window_pixels,
+        job.encoding,
+        job.scale,
+        job.resample,
+        job.scale_before_fill,
+        img,
+    )
 
-        generate_single_image(input_path, output_path, padding_lrtb)
+    if image_cache is not None:
+        image_cache.store(key, job.output_path, job.output_path.suffix)
+    return "generated"
+
+
+def validate_images(
+    configs: "list[ImagesConfig]",
+    bleed_size: float,
+    jobs=1,
+    image_filter: "Callable[[ImageInfo], bool] | None" = None,
+):
+    # Catch missing files and bad geometry before spending any time on image
+    # generation. Only image headers are read, so threads are enough
+    start_time = time.perf_counter()
+    image_infos = list(
+        filter(
+            image_filter,
+            itertools.chain.from_iterable(c.all_images_iter() for c in configs),
+        )
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        errors = list(
+            itertools.chain.from_iterable(
+                executor.map(lambda info: info.validate(bleed_size), image_infos)
+            )
+        )
+    for config in configs:
+        config.index.flush()
+
+    logger.debug(
+        f"Validated {len(image_infos)} images in "
+        + f"{(time.perf_counter() - start_time) * 1000:.1f} ms"
+    )
+    if errors:
+        for error in errors:
+            logger.error(error)
+        logger.critical(f"Found {len(errors)} problem(s) with the images")
+        sys.exit(1)
+
+
+def init_image_worker(log_level: int):
+    # Worker processes may be spawned rather than forked, so they don't
+    # necessarily inherit the log level set in `main`
+    logger.setLevel(log_level)
+    # Each worker already runs on its own core
+    cv2.setNumThreads(1)
+
+
+def image_process_pool(jobs: int) -> concurrent.futures.ProcessPoolExecutor:
+    # Workers are started on the first job, while other threads (a first pass'
+    # output reader, other variants) may hold locks that a fork would copy
+    # held, so they're forked from a single-threaded server where available
+    mp_context = None
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("forkserver")
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=mp_context,
+        initializer=init_image_worker,
+        initargs=(logger.getEffectiveLevel(),),
+    )
+
+
+def volume_image_jobs(
+    configs: "list[ImageInfo]",
+    work_dir: Path,
+    bleed_size: float,
+    settings: "ImageSettings",
+    image_filter: "Callable[[ImageInfo], bool] | None" = None,
+) -> "list[ImageJob]":
+    image_jobs = []
+    for config in configs:
+        for image_info in filter(image_filter, config.all_images_iter()):
+            job = ImageJob(image_info, work_dir, bleed_size, settings)
+            if image_info is getattr(config, "toc", None):
+                # The page numbers are drawn onto a copy after the first pass
+                job.output_path = toc_base_image_path(job.output_path)
+            image_jobs.append(job)
+        config.index.flush()
+    return image_jobs
+
+
+def generate_images(
+    configs: "list[ImageInfo]",
+    work_dir: Path,
+    bleed_size: float,
+    settings: "ImageSettings",
+    image_cache: ImageCache | None = None,
+    jobs=1,
+    epub_outputs: "dict[Path, list[tuple[Path, bool]]] | None" = None,
+    executor: concurrent.futures.Executor | None = None,
+    image_filter: "Callable[[ImageInfo], bool] | None" = None,
+):
+    # With `executor`, the images are generated there (e.g. in a pool shared
+    # by several variants) instead of in a new pool of `jobs` processes
+    # With `image_filter`, only the images it accepts are generated
+    # `epub_outputs` maps source images to the EPUB images to produce from
+    # them, so that each source is only decoded once when building both
+    logger.info("==Generating images==")
+    epub_outputs = dict(epub_outputs or {})
+    image_jobs = volume_image_jobs(
+        configs, work_dir, bleed_size, settings, image_filter
+    )
+    for job in image_jobs:
+        job.epub_outputs = epub_outputs.pop(job.input_path, [])
+    if epub_outputs:
+        raise ValueError(f"EPUB images without a matching image: {list(epub_outputs)}")
+
+    # Identical sources with identical parameters (e.g. a cover reused as a
+    # filler) are only generated once, then linked to the other destinations
+    duplicates: dict[tuple, list[ImageJob]] = {}
+    for job in image_jobs:
+        duplicates.setdefault(job.dedup_key(), []).append(job)
+    unique_jobs = [group[0] for group in duplicates.values()]
+    for job, *copies in duplicates.values():
+        for copy in copies:
+            job.epub_outputs.extend(copy.epub_outputs)
+    if len(unique_jobs) < len(image_jobs):
+        logger.info(
+            f"Generating {len(unique_jobs)} unique images for {len(image_jobs)} destinations"
+        )
+
+    outcomes = collections.Counter()
+    failed_jobs = []
+    if executor is None and jobs <= 1:
+        for job in unique_jobs:
+            try:
+                outcomes[run_image_job(job, image_cache)] += 1
+            except Exception as e:
+                logger.error(f"Could not generate image {job.name}", exc_info=e)
+                failed_jobs.append(job)
+    else:
+        with contextlib.ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(image_process_pool(jobs))
+            futures = {
+                executor.submit(run_image_job, job, image_cache): job
+                for job in unique_jobs
+            }
+            for future in concurrent.futures.as_completed(futures):
+                job = futures[future]
+                try:
+                    outcomes[future.result()] += 1
+                except Exception as e:
+                    logger.error(f"Could not generate image {job.name}", exc_info=e)
+                    failed_jobs.append(job)
+
+    for job, *copies in duplicates.values():
+        if job in failed_jobs:
+            continue
+        for copy in copies:
+            logger.debug(f"Linking {copy.name} to identical image {job.name}")
+            os.makedirs(copy.output_path.parent, exist_ok=True)
+            link_or_copy(job.output_path, copy.output_path)
+
+    if image_cache is not None:
+        evicted = image_cache.evict()
+        # Unchanged sources are linked without looking them up, so they are
+        # neither hits nor misses
+        logger.info(
+            f"Image cache: {outcomes['cached']} hits, "
+            + f"{outcomes['generated']} misses, {evicted} evicted "
+            + f"({outcomes['linked']} unchanged images linked from the source)"
+        )
+
+    if failed_jobs:
+        logger.critical(f"Failed to generate {len(failed_jobs)} image(s)")
+        sys.exit(1)
 
 
 def generate_single_image(
     input_path: Path,
     output_path: Path,
     padding_lrtb: "tuple[float, float, float, float]",
+    bleed_fill="telea",
+    inpaint_mode="band",
+    max_window_pixels: int | None = None,
+    encoding="png",
+    scale=1.0,
+    resample="area",
+    scale_before_fill=False,
+    img=None,
 ):
+    # `img` may be the already decoded input image
+    if all(p <= 0 for p in padding_lrtb):
+        # Nothing to fill, the image only needs to be cropped
+        generate_cropped_image(
+            input_path, output_path, padding_lrtb, encoding, scale, resample, img
+        )
+        return
+
+    if max_window_pixels is not None:
+        generate_single_image_tiled(
+            input_path,
+            output_path,
+            padding_lrtb,
+            bleed_fill,
+            max_window_pixels,
+            encoding,
+            scale,
+            resample,
+        )
+        return
+
     os.makedirs(output_path.parent, exist_ok=True)
-    img = cv2.imread(str(input_path))
+    if img is None:
+        img = cv2.imread(str(input_path))
     logger.debug(np.shape(img))
 
     l, r, t, b = padding_lrtb
     logger.debug((l, r, t, b))
-    mask = np.ones((img.shape[0], img.shape[1]), dtype=np.uint8) * 255
-    mask = crop_and_pad_mat(mask, [(t, b), (l, r)])
-    mask = 255 - mask
     img = crop_and_pad_mat(img, [(t, b), (l, r)])
     logger.debug(img.dtype)
     logger.debug(img.shape)
 
+    if scale_before_fill and scale != 1.0:
+        img, padding_lrtb = scale_padded_canvas(img, padding_lrtb, scale, resample)
+        scale = 1.0
+
     cv2.setRNGSeed(42)  # For consistent generation between runs
-    img = cv2.inpaint(img, mask, 2, cv2.INPAINT_TELEA)
+    img = fill_bleed(img, padding_lrtb, bleed_fill, INPAINT_RADIUS, inpaint_mode)
+
+    logger.debug(output_path)
+    write_image(output_path, img, encoding, scale, resample)
+
+
+def scaled_size(shape, scale: float) -> "tuple[int, int]":
+    # The images are placed by height in LaTeX, so the aspect ratio is all
+    # that needs to be preserved
+    h, w = shape[:2]
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+
+def scale_padded_canvas(
+    img, padding_lrtb: "tuple[int, int, int, int]", scale: float, resample="area"
+):
+    # Downsamples a padded (not yet filled) canvas. Returns the padding of the
+    # scaled canvas, which covers every pixel that mixes in the empty padding
+    h, w = img.shape[:2]
+    size = scaled_size(img.shape, scale)
+    fx, fy = size[0] / w, size[1] / h
+
+    l, r, t, b = (max(0, p) for p in padding_lrtb)
+    scaled_padding = (
+        math.ceil(l * fx),
+        size[0] - math.floor((w - r) * fx) if r > 0 else 0,
+        math.ceil(t * fy),
+        size[1] - math.floor((h - b) * fy) if b > 0 else 0,
+    )
+    img = cv2.resize(img, size, interpolation=RESAMPLE_FILTERS[resample])
+    return img, scaled_padding
+
+
+def write_image(output_path: Path, img, encoding="png", scale=1.0, resample="area"):
+    if scale != 1.0:
+        size = scaled_size(img.shape, scale)
+        img = cv2.resize(img, size, interpolation=RESAMPLE_FILTERS[resample])
+    # The output may be a hardlink into the image cache, so never write through it
+    output_path.unlink(missing_ok=True)
+    cv2.imwrite(str(output_path), img, IMAGE_ENCODINGS[encoding][1])
+
+
+def is_passthrough_image(
+    input_path: Path, padding_lrtb: "tuple[float, float, float, float]"
+) -> bool:
+    # Whether the generated image would be identical to the source, i.e. it
+    # needs no padding or cropping and is already an 8-bit RGB PNG, which is
+    # what `cv2.imwrite` would produce
+    if any(p != 0 for p in padding_lrtb) or input_path.suffix.lower() != ".png":
+        return False
+    with open(input_path, "rb") as f:
+        header = f.read(26)
+    # PNG signature, then the IHDR chunk: length, type, width, height, bit
+    # depth and color type (2 is RGB)
+    return (
+        header[:8] == b"\x89PNG\r\n\x1a\n"
+        and header[12:16] == b"IHDR"
+        and header[24] == 8
+        and header[25] == 2
+    )
+
+
+def generate_cropped_image(
+    input_path: Path,
+    output_path: Path,
+    padding_lrtb: "tuple[float, float, float, float]",
+    encoding="png",
+    scale=1.0,
+    resample="area",
+    img=None,
+):
+    os.makedirs(output_path.parent, exist_ok=True)
+    if img is None:
+        img = cv2.imread(str(input_path))
+
+    l, r, t, b = padding_lrtb
+    img = crop_mat(img, [(-t, -b), (-l, -r)])
 
     logger.debug(output_path)
-    cv2.imwrite(str(output_path), img)
+    write_image(output_path, img, encoding, scale, resample)
+
+
+def generate_single_image_tiled(
+    input_path: Path,
+    output_path: Path,
+    padding_lrtb: "tuple[float, float, float, float]",
+    bleed_fill: str,
+    max_window_pixels: int,
+    encoding="png",
+    scale=1.0,
+    resample="area",
+):
+    # Like `generate_single_image` with `inpaint_mode="band"`, but the padded
+    # canvas lives in a memory-mapped file, and only one inpainting window is
+    # held in memory at a time. The output is only approximately the same:
+    # inpainting each tile separately changes the fill near the tile edges. On
+    # the volumes' images, up to 6 levels on under 1% of the pixels with the
+    # smallest windows (64 Ki pixels), and up to 2 levels with 128 Ki pixels.
+    # The known pixels are never changed
+    os.makedirs(output_path.parent, exist_ok=True)
+    logger.debug(f"Inpainting in windows of at most {max_window_pixels} pixels")
+
+    l, r, t, b = padding_lrtb
+    canvas_path = output_path.with_name(output_path.name + ".canvas")
+    with Image.open(input_path) as pil_img:
+        src_slices, dst_slices, canvas_shape = crop_and_pad_slices(
+            (pil_img.height, pil_img.width, 3), [(t, b), (l, r)]
+        )
+        canvas = np.memmap(canvas_path, dtype=np.uint8, mode="w+", shape=canvas_shape)
+
+        try:
+            if pil_img.mode in ("RGB", "RGBA"):
+                # PIL keeps decoded images more compactly than OpenCV, and lets us
+                # convert to BGR a few rows at a time
+                src_rows, src_cols = src_slices[:2]
+                dst_rows, dst_cols = dst_slices[:2]
+                chunk_rows = max(1, max_window_pixels // pil_img.width)
+                for y in range(src_rows.start, src_rows.stop, chunk_rows):
+                    y_end = min(src_rows.stop, y + chunk_rows)
+                    chunk = np.asarray(
+                        pil_img.crop((src_cols.start, y, src_cols.stop, y_end))
+                    )
+                    dst_y = dst_rows.start + (y - src_rows.start)
+                    canvas[dst_y : dst_y + (y_end - y), dst_cols] = chunk[..., 2::-1]
+                    del chunk
+            else:
+                img = cv2.imread(str(input_path))
+                canvas[dst_slices] = img[src_slices]
+                del img
+        except:
+            del canvas
+            canvas_path.unlink(missing_ok=True)
+            raise
+
+    try:
+        cv2.setRNGSeed(42)  # For consistent generation between runs
+        inpaint_bands(
+            canvas,
+            padding_lrtb,
+            INPAINT_RADIUS,
+            INPAINT_METHODS[bleed_fill],
+            max_window_pixels=max_window_pixels,
+            in_place=True,
+        )
+
+        logger.debug(output_path)
+        write_image(output_path, canvas, encoding, scale, resample)
+    finally:
+        del canvas
+        canvas_path.unlink(missing_ok=True)
 
 
 def crop_and_pad_mat(mat, pad_crop_values):
@@ -515,6 +2123,24 @@ def crop_and_pad_mat(mat, pad_crop_values):
     return mat
 
 
+def crop_and_pad_slices(shape, pad_crop_values):
+    # Equivalent to `crop_and_pad_mat`, but returns the part of the input that
+    # is kept, where it ends up, and the resulting shape, without copying
+    pad_crop_values = tuple(pad_crop_values) + (
+        ((0, 0),) * (len(shape) - len(pad_crop_values))
+    )
+
+    src_slices = []
+    dst_slices = []
+    result_shape = []
+    for size, (a, b) in zip(shape, pad_crop_values):
+        kept = size - max(0, -a) - max(0, -b)
+        src_slices.append(slice(max(0, -a), max(0, -a) + kept))
+        dst_slices.append(slice(max(0, a), max(0, a) + kept))
+        result_shape.append(kept + max(0, a) + max(0, b))
+    return tuple(src_slices), tuple(dst_slices), tuple(result_shape)
+
+
 def crop_mat(mat, crop_values):
     crop_values = tuple(crop_values) + (((0, 0),) * (len(mat.shape) - len(crop_values)))
     slices = tuple(slice(start or None, -end or None) for start, end in crop_values)
@@ -528,10 +2154,27 @@ def cv2_to_pil(img, from_space="BGR", to_space="RGB"):
     return Image.fromarray(converted, to_space)
 
 
-def main():
+def pil_to_cv2(img, to_space="BGR"):
+    flag = getattr(cv2, f"COLOR_{img.mode}2{to_space}")
+    return cv2.cvtColor(np.asarray(img), flag)
+
+
+def parse_variants(s: str) -> list[str]:
+    variants = [v.strip() for v in s.split(",") if v.strip()]
+    for variant in variants:
+        if variant not in VARIANTS:
+            raise argparse.ArgumentTypeError(
+                f"unknown variant '{variant}' (choose from {', '.join(VARIANTS)})"
+            )
+    return list(dict.fromkeys(variants))
+
+
+def argument_parser(
+    prog="output_tex", description="Converts the input .md files to .tex files."
+) -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
-        prog="output_tex",
-        description="Converts the input .md files to .tex files.",
+        prog=prog,
+        description=description,
         formatter_class=ColorHelpFormatter,
         add_help=False,
     )
@@ -539,10 +2182,8 @@ def main():
     # Custom action for `--print-mode`
     class PrintMode(argparse.Action):
         def __call__(self, parser, namespace, values, option_string=None):
-            setattr(namespace, "bleed_size", "0.125in")
-            setattr(namespace, "gutter_size", "0.15in")
-            setattr(namespace, "no_front_cover", True)
-            setattr(namespace, "no_back_cover", True)
+            for name, value in PRINT_MODE_OPTIONS.items():
+                setattr(namespace, name, value)
 
     parser.add_argument("input_dir")
     parser.add_argument("output_dir")
@@ -568,11 +2209,18 @@ def main():
         help="Specify gutter size. Recommended size is 0.15in, if printing.",
     )
     parser.add_argument("-v", "--verbose", action="store_true", help="Be verbose.")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=os.cpu_count() or 1,
+        type=int,
+        help="Number of images to generate in parallel. Defaults to the number of CPUs.",
+    )
     parser.add_argument(
         "-x",
         "--xelatex-command-line",
         type=str,
-        help=f"Allow overriding the command used to call xelatex. This will be formatted with `{colors.faint('str.format')}`, with keyword arguments MODE (optional to preserve verbosity), OUTPUT_DIRECTORY, JOB_NAME, and TEX_FILE. The default is `{colors.faint(xelatex_default_miktex)}` for MiKTeX, and `{colors.faint(xelatex_default_texlive)}` for TeX Live and other TeX distributions.",
+        help=f"Allow overriding the command used to call xelatex. This will be formatted with `{colors.faint('str.format')}`, with keyword arguments MODE (optional to preserve verbosity), FORMAT (optional, the precompiled preamble; the argument containing it is left out when there is none), OUTPUT_DIRECTORY, JOB_NAME, and TEX_FILE. The default is `{colors.faint(xelatex_default_miktex)}` for MiKTeX, and `{colors.faint(xelatex_default_texlive)}` for TeX Live and other TeX distributions.",
     )
     parser.add_argument(
         "--version-tag",
@@ -612,6 +2260,109 @@ def main():
         action="store_true",
         help="Skip generating the images. Will use previously generated images. Speeds up execution.",
     )
+    parser.add_argument(
+        "--bleed-fill",
+        choices=BLEED_FILL_STRATEGIES,
+        default="telea",
+        help=f"How to fill the bleed of images that don't set `{colors.faint('bleed_fill')}` in their config. `telea` and `ns` inpaint the padding, `replicate` and `reflect` extend the edge pixels, and `blur-replicate` extends and blurs them. The non-inpainting strategies are much faster and work well for flat borders.",
+    )
+    parser.add_argument(
+        "--inpaint-mode",
+        choices=["band", "full"],
+        default="band",
+        help="How to fill the bleed. `band` only inpaints the padded edges of each image, `full` inpaints the whole canvas (slower, same result within a few color levels).",
+    )
+    parser.add_argument(
+        "--image-memory-budget",
+        type=str,
+        help="Approximate peak memory to use per image job, e.g. `512MiB`. Images that would exceed it are padded onto a memory-mapped canvas and inpainted in bounded windows, which fills the bleed slightly differently (by a few levels at most). Only applies to `--inpaint-mode band`.",
+    )
+    parser.add_argument(
+        "--image-encoding",
+        choices=list(IMAGE_ENCODINGS),
+        default="png",
+        help="File format of the generated images. `png-fast` uses the lowest zlib level, `png-archival` the highest, and `jpeg` writes high-quality JPEG files, which xdvipdfmx embeds without re-compressing them.",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["full", "screen", "draft"],
+        default="full",
+        help=f"`full` embeds the images at their source resolution. `screen` downsamples them to `{colors.faint('--screen-dpi')}` for a smaller PDF meant for reading on screens. `draft` uses low-resolution proxies (see `{colors.faint('--draft-scale')}`) with the same layout, for proofreading. The `screen` and `draft` profiles build in their own work directory and output file.",
+    )
+    parser.add_argument(
+        "--screen-dpi",
+        default=150,
+        type=float,
+        help="Effective resolution of the images with `--profile screen`.",
+    )
+    parser.add_argument(
+        "--draft-scale",
+        default=0.125,
+        type=float,
+        help="Scale of the proxy images with `--profile draft`.",
+    )
+    parser.add_argument(
+        "--resample",
+        choices=list(RESAMPLE_FILTERS),
+        default="area",
+        help="Interpolation used to downsample the images.",
+    )
+    parser.add_argument(
+        "--vector-toc",
+        action="store_true",
+        help="Typeset the TOC page numbers over the TOC image from page references, instead of drawing them onto the image between the xelatex passes. xelatex is rerun until the references are stable.",
+    )
+    parser.add_argument(
+        "--hermetic-fonts",
+        action="store_true",
+        help=f"Run xelatex with a fontconfig configuration that only contains the bundled fonts in `{colors.faint('Common/TeX/Fonts')}`, with its own cache in `{colors.faint('.cache/fonts')}`, prewarmed with `{colors.faint('fc-cache')}` if available. The fonts of `{colors.faint('WorldEnd2_Common.tex')}` are loaded by file (fontspec's `{colors.faint('Path')}`), so this only affects fonts looked up by name, which then can't be system or TeX Live fonts.",
+    )
+    parser.add_argument(
+        "--xelatex-format",
+        action="store_true",
+        help=f"Precompile the static preamble into an xelatex format (stored in `{colors.faint('.cache/formats')}`, requires mylatexformat), instead of processing it in every xelatex pass. A format that fails to build is not tried again until the preamble or xelatex changes.",
+    )
+    parser.add_argument(
+        "--variants",
+        type=parse_variants,
+        help=f"Comma-separated variants to build in one run, e.g. `{colors.faint('print,screen')}`. They share the parsing and the text conversion, and are built concurrently, each in its own work directory (`{colors.faint('WorkDir/TeX-<variant>')}`) and output file (`{colors.faint('WorldEnd2_vXX-<variant>.pdf')}`). Each variant overrides the bleed, gutter, cover and profile options: `print` is like `{colors.faint('--print-mode')}`, `digital` has no bleed or gutter and includes the covers, and `screen` and `draft` are like `digital` with the corresponding `{colors.faint('--profile')}`. Choose from: {', '.join(VARIANTS)}.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Compile the front matter, each chapter and the back cover as separate xelatex jobs, starting on the pages they started on in the last full build, and stitch them together. Unchanged segments are reused, and the others are compiled in parallel (see --jobs). Falls back to a full build if a segment's page count changed.",
+    )
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help=f"Ignore the build journal (`{colors.faint('WorkDir/TeX/journal.json')}`) and run every stage of the build. By default, the text conversion, the images, the first pass, the TOC and the second pass are skipped if their inputs and outputs are unchanged since they last completed, so a failed build resumes from the stage that failed.",
+    )
+    parser.add_argument(
+        "--only-chapter",
+        type=parse_chapters,
+        help=f"Only build the given chapters, e.g. `{colors.faint('3')}`, `{colors.faint('2-4')}` or `{colors.faint('1,3-5')}`, as a preview for proofreading (`{colors.faint('WorldEnd2_vXX-preview.pdf')}`). Each chapter starts on the page it started on in the last full build in the same output directory, so the folios and headers match. Only the images of those chapters are generated.",
+    )
+    parser.add_argument(
+        "--speculative",
+        action="store_true",
+        help="Skip the first xelatex pass by reusing the chapter page numbers of the previous build in the same output directory. A corrective pass is only run if they changed.",
+    )
+    parser.add_argument(
+        "--no-image-cache",
+        action="store_true",
+        help="Don't reuse or store generated images in the image cache.",
+    )
+    parser.add_argument(
+        "--image-cache-dir",
+        type=str,
+        help=f"Directory of the persistent image cache. The default is `{colors.faint('.cache/images')}` in the project root.",
+    )
+    parser.add_argument(
+        "--image-cache-size",
+        default="2GiB",
+        type=str,
+        help="Maximum size of the image cache. Least-recently-used images are evicted past this size.",
+    )
     parser.add_argument(
         "-I",
         "--no-images",
@@ -619,8 +2370,28 @@ def main():
         help="Don't print the images to the PDF. Greatly speeds up execution.",
     )
 
-    args = parser.parse_args()
+    return parser
+
+
+def parse_chapters(s: str) -> list[int]:
+    # E.g. `3`, `2-4` or `1,3-5`
+    chapters = []
+    for item in s.split(","):
+        match = regex.fullmatch(r"\s*(\d+)\s*(?:-\s*(\d+)\s*)?", item)
+        if match is None:
+            raise argparse.ArgumentTypeError(f"invalid chapter or range '{item}'")
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if last < first:
+            raise argparse.ArgumentTypeError(f"invalid chapter range '{item}'")
+        chapters.extend(range(first, last + 1))
+    return sorted(set(chapters))
 
+
+def convert_book_from_args(
+    args: argparse.Namespace,
+    epub_outputs: "dict[Path, list[tuple[Path, bool]]] | None" = None,
+):
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
@@ -646,27 +2417,126 @@ def main():
     os.makedirs(output_dir, exist_ok=True)
     output_dir = output_dir.resolve()
 
-    work_dir = output_dir / "WorkDir" / "TeX"
-    os.makedirs(work_dir, exist_ok=True)
-    work_dir = work_dir.resolve()
-
     images_config = parse_image_config(book_config.directory / "Images")
 
-    convert_book(
-        book_config,
-        images_config,
-        version_tag,
-        output_dir,
-        work_dir,
-        length_to_inches(args.bleed_size),
-        args.no_inner_bleed,
-        args.no_images,
-        args.skip_image_generation,
-        xelatex_command,
-        args.no_front_cover,
-        args.no_back_cover,
-        length_to_inches(args.gutter_size),
-    )
+    image_cache = None
+    if not args.no_image_cache:
+        image_cache_dir = args.image_cache_dir or (cache_dir() / "images")
+        image_cache = ImageCache(
+            Path(image_cache_dir).absolute(), size_to_bytes(args.image_cache_size)
+        )
+
+    def convert_variant(
+        variant_args: argparse.Namespace,
+        output_suffix: str,
+        epub_outputs=None,
+        image_executor=None,
+    ):
+        work_dir = output_dir / "WorkDir" / f"TeX{output_suffix}"
+        os.makedirs(work_dir, exist_ok=True)
+        work_dir = work_dir.resolve()
+
+        return convert_book(
+            book_config,
+            images_config,
+            version_tag,
+            output_dir,
+            work_dir,
+            length_to_inches(variant_args.bleed_size),
+            variant_args.no_inner_bleed,
+            variant_args.no_images,
+            variant_args.skip_image_generation,
+            xelatex_command,
+            variant_args.no_front_cover,
+            variant_args.no_back_cover,
+            length_to_inches(variant_args.gutter_size),
+            image_cache,
+            variant_args.jobs,
+            ImageSettings(
+                variant_args.bleed_fill,
+                variant_args.inpaint_mode,
+                (
+                    size_to_bytes(variant_args.image_memory_budget)
+                    if variant_args.image_memory_budget
+                    else None
+                ),
+                variant_args.image_encoding,
+                (variant_args.screen_dpi if variant_args.profile == "screen" else None),
+                variant_args.resample,
+                (variant_args.draft_scale if variant_args.profile == "draft" else None),
+            ),
+            output_suffix,
+            variant_args.vector_toc,
+            epub_outputs,
+            variant_args.speculative,
+            variant_args.xelatex_format,
+            variant_args.incremental,
+            image_executor,
+            variant_args.hermetic_fonts,
+            variant_args.only_chapter,
+            variant_args.fresh,
+        )
+
+    if not args.variants:
+        output_suffix = "" if args.profile == "full" else f"-{args.profile}"
+        convert_variant(args, output_suffix, epub_outputs)
+        return
+
+    # The variants share the parsed configs, the converted texts and one pool
+    # for image generation, and run their xelatex passes concurrently. Each
+    # builds in its own work directory and output file
+    for chapter in book_config.chapters:
+        for part in chapter.parts:
+            format_text(part.text_filepath().read_text())
+
+    with contextlib.ExitStack() as stack:
+        image_executor = None
+        if args.jobs > 1:
+            image_executor = stack.enter_context(image_process_pool(args.jobs))
+        variant_executor = stack.enter_context(
+            concurrent.futures.ThreadPoolExecutor(max_workers=len(args.variants))
+        )
+        futures = {}
+        for i, variant in enumerate(args.variants):
+            variant_args = argparse.Namespace(**{**vars(args), **VARIANTS[variant]})
+            logger.info(f"==Building variant {variant}==")
+            variant_build = VariantBuild(variant)
+            context = contextvars.copy_context()
+            context.run(current_variant.set, variant_build)
+            future = variant_executor.submit(
+                context.run,
+                convert_variant,
+                variant_args,
+                f"-{variant}",
+                # The EPUB images only need to be written once
+                epub_outputs if i == 0 else None,
+                image_executor,
+            )
+            futures[future] = variant_build
+
+        # The first failure stops the other variants, instead of letting them
+        # finish their builds before it is reported
+        failure = None
+        for future in concurrent.futures.as_completed(futures):
+            variant_build = futures[future]
+            try:
+                future.result()
+                logger.info(f"==Finished variant {variant_build.name}==")
+            except BaseException as e:
+                if variant_build.cancelled:
+                    logger.info(f"==Cancelled variant {variant_build.name}==")
+                    continue
+                logger.error(f"==Variant {variant_build.name} failed==")
+                if failure is None:
+                    failure = e
+                    for other_build in futures.values():
+                        other_build.cancel()
+        if failure is not None:
+            raise failure
+
+
+def main():
+    convert_book_from_args(argument_parser().parse_args())
 
 
 if __name__ == "__main__":